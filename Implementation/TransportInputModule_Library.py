@@ -4,18 +4,37 @@ from pyModbusTCP.utils import set_bit
 from pyModbusTCP.utils import reset_bit
 from pyModbusTCP.utils import test_bit
 from time import sleep
+from time import perf_counter
+from time import monotonic
 
 from multiprocessing import BoundedSemaphore
+from threading import Lock
 
 
 
+class TransportInputModule_Stop_Latched_Error(ValueError):
+    #Raised for commands which would start a conveyor while the emergency stop of conveyor_stop_all() is latched
+    pass
+
+
 class TransportInputModule_Library:
     #Konstanten
     DIGITAL_INPUT_STARTING_ADDRESS = 8001
     DIGITAL_OUTPUT_STARTING_ADDRESS = 8018
+    #Number of input registers which cover all input bits (offset 0 - 5, see get_offset())
+    INPUT_REGISTER_COUNT = 6
+    #Number of output registers which cover all output bits for conveyors and switches (offset 0 - 3, see get_offset())
+    OUTPUT_REGISTER_COUNT = 4
+    #Number of attempts of every request of conveyor_stop_all() before the stop is reported as failed
+    STOP_ATTEMPTS = 3
 
     INDEX_CONVEYORS = ['A', 'B', 'C', 'D', 'H', 'I', 'J', 'L', 'M', 'P', 'Q', 'R', 'U', 'V']
     INDEX_SWITCHES = ['E', 'F', 'G', 'K', 'N', 'O', 'S', 'T', 'W']
+    #Analog modules for the conveyor speed: (control register, first value register, conveyors of the first four values, conveyors of the second four values)
+    SPEED_MODULES = [
+        (8024, 8025, ['A', 'B', 'C', 'D'], ['H', 'I', 'J', 'L']),
+        (8029, 8030, ['M', 'P', 'Q', 'R'], ['U', 'V']),
+    ]
     #maps index of the conveyors and switches to the Digital I/Os which they are connected to
     INDEX ={
         #Conveyor Index: Outputs -> [>>Move forwards<<, >>Move backward<<], Inputs -> [>>Piece at begin of conveyor<<, >>Piece at end of conveyor<<]
@@ -47,16 +66,24 @@ class TransportInputModule_Library:
     }
 
 
-    def __init__(self,ip_addr, read_write_sem = BoundedSemaphore(value=1)):
+    def __init__(self,ip_addr, read_write_sem = BoundedSemaphore(value=1), port = 502, reconcile_interval = 1.0):
        #"""
         #constructor of the TransportInputModule.
 
         #:param ip_addr IP address of the Modbus note, which is responsible for the module (String)
         #:param read_write_sem semaphore which can be passed, if reading/writing of I/Os by two modules at the same time has to be locked
+        #:param port TCP port of the Modbus node (only differs from 502 for a Modbus stand-in, see TransportInputModule_OPCUA_Load_Test.py)
+        #:param reconcile_interval Seconds after which the output image is read back from the Modbus node before it is used again
+        #(None = read back before every use)
+        #(reconcile_output_image() should be called more often than that, e.g. by the thread which publishes the statistics)
         #"""
         try:
              #Establishes a connection through Modbus to ip_addr
-            self.client = ModbusClient(host=ip_addr, auto_open=True, auto_close=True)
+            self.client = ModbusClient(host=ip_addr, port=port, auto_open=True, auto_close=True)
+
+            #Dedicated connection for conveyor_stop_all(), which stays open so that a stop neither waits behind the
+            #requests of self.client nor for a TCP connection setup
+            self.stop_client = ModbusClient(host=ip_addr, port=port, auto_open=True, auto_close=False)
         except ValueError:
             print("Error with host param")
 
@@ -65,6 +92,43 @@ class TransportInputModule_Library:
 
         self.read_write_sem = read_write_sem
 
+        #Set by conveyor_stop_all(): as long as it is set, set_output_register() clears all bits for forward/backward,
+        #so that a read-modify-write which was in progress during the stop cannot restart a conveyor
+        self.stop_latched = False
+
+        #Output registers as they were last commanded through set_output_register() (offset -> register), number of these writes
+        #which were started and which were finished. conveyor_stop_all() takes the switch bits from commanded_registers and repeats
+        #its read and write until no write of set_output_register() was in progress or started meanwhile
+        self.commanded_registers = {}
+        self.started_writes = 0
+        self.finished_writes = 0
+
+        #Output image: the output registers (offset 0 - 3) as they were last written or read back. Commands are applied to
+        #this image and only the bits which change are written, commands which do not change any bit are suppressed.
+        #The image is reconciled with the Modbus node by a read back after reconcile_interval; output_image = None means that
+        #the image is unknown and read back before its next use.
+        #conveyor_stop_all() changes the outputs past self.sem and increments output_image_generation, a read back or write
+        #which started before does not update the image. image_lock protects the image against this race
+        self.output_image = None
+        self.output_image_time = 0.0
+        self.output_image_generation = 0
+        self.image_lock = Lock()
+        self.reconcile_interval = reconcile_interval
+
+        #Number of suppressed writes and of registers which differed from the output image when it was read back or written
+        self.suppressed_writes = 0
+        self.reconcile_mismatches = 0
+
+        #Whether the speeds in self.conveyor_speed were written at least once, before that a speed write is never suppressed
+        self.conveyor_speed_written = False
+
+        #Number of speed writes of update_conveyor_speed() and of conveyor_stop_all() which were started and finished. Both write
+        #the same control registers over different connections, if they overlap the speeds on the Modbus node are unknown
+        self.speed_updates_started = 0
+        self.speed_updates_finished = 0
+        self.speed_stops_started = 0
+        self.speed_stops_finished = 0
+
         #Conveyor Speed: 0 = 0V/0% (default) | 30000 = 10V/100%
         self.conveyor_speed = {
             'A' : 0,
@@ -113,17 +177,199 @@ class TransportInputModule_Library:
                 result = self.client.read_holding_registers(reg_addr=self.DIGITAL_INPUT_STARTING_ADDRESS + offset,reg_nb = amount)
             return result
 
-    def set_output_register(self, register, offset = 0):
+    def get_input_image(self):
+        #"""
+        #Returns all input registers of the module (offset 0 - 5, see get_offset()) read with a single Modbus request.
+        #The image can be passed to the check_* methods, so that one scan cycle needs only one read instead of one per sensor.
+
+        #:returns List of the input registers, indexed by the offset
+        #:rtype list of int
+        #"""
+        return self.get_input_register(offset=0, amount=self.INPUT_REGISTER_COUNT)
+
+    def get_input_word(self, offset, image = None):
+        #"""
+        #Returns the input register at offset, either from the passed input image or read from the Modbus node.
+
+        #:param offset Offset to the DIGITAL_INPUT_STARTING_ADDRESS
+        #:param image input image from get_input_image() or None
+        #:returns input register
+        #:rtype int
+        #"""
+        if image is not None:
+            return image[offset]
+        return self.get_input_register(offset)[0]
+
+    def set_output_register(self, register, offset = 0, mask = None):
         #"""
         #Overwrites output register of the Modbus node.
 
         #:param register List of int, which are supposed to be written to the register
         #:param offset Offset to the DIGITAL_OUTPUT_STARTING_ADDRESS
+        #:param mask List of int with the bits of each register which are written (None = all bits). The other bits are read
+        #from the Modbus node while read_write_sem is held and written unchanged, so that bits of other commands are kept
+        #:returns List of the registers as they were written
+        #:rtype list of int
         #"""
+        generation = self.output_image_generation
         with self.read_write_sem:
+            #counted before stop_latched is checked, so that conveyor_stop_all() either sees this write or it is masked
+            self.started_writes += 1
+            if mask is not None:
+                current = None
+                while current == None:
+                    current = self.client.read_holding_registers(reg_addr=self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, reg_nb=len(register))
+                register = [(current[i] & ~mask[i]) | (register[i] & mask[i]) for i in range(len(register))]
+            if self.stop_latched:
+                register = self.clear_conveyor_bits(register, offset)
+            for i in range(len(register)):
+                self.commanded_registers[offset + i] = register[i]
+
             result = None
             while result == None:
                 result = self.client.write_multiple_registers(self.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, register)
+            self.finished_writes += 1
+
+        with self.image_lock:
+            image = self.output_image
+            if image is not None and generation == self.output_image_generation:
+                for i in range(len(register)):
+                    if offset + i < self.OUTPUT_REGISTER_COUNT:
+                        image[offset + i] = register[i]
+        return register
+
+    def get_output_image(self):
+        #"""
+        #Returns a copy of the output image, which is read back from the Modbus node first if it is missing or older than reconcile_interval.
+        #Has to be called while self.sem is held.
+
+        #:returns List of the output registers (offset 0 - 3), indexed by the offset
+        #:rtype list of int
+        #"""
+        image = self.output_image
+        if image is None or self.reconcile_interval is None or monotonic() - self.output_image_time >= self.reconcile_interval:
+            image = self.read_back_output_image()
+        return list(image)
+
+    def read_back_output_image(self):
+        #"""
+        #Reads the output registers (offset 0 - 3) with one request, counts the registers which differ from the output image
+        #in reconcile_mismatches and takes the read registers as new output image. A read back during which conveyor_stop_all()
+        #changed the outputs is repeated. Has to be called while self.sem is held.
+
+        #:returns List of the read output registers
+        #:rtype list of int
+        #"""
+        while True:
+            generation = self.output_image_generation
+            reg = self.get_output_register(offset=0, amount=self.OUTPUT_REGISTER_COUNT)
+            with self.image_lock:
+                if generation == self.output_image_generation:
+                    if self.output_image is not None:
+                        self.reconcile_mismatches += sum(1 for offset in range(self.OUTPUT_REGISTER_COUNT) if reg[offset] != self.output_image[offset])
+                    self.output_image = list(reg)
+                    self.output_image_time = monotonic()
+                    return list(reg)
+
+    def reconcile_output_image(self):
+        #"""
+        #Reconciles the output image with the Modbus node immediately (see read_back_output_image()).
+        #"""
+        with self.sem:
+            self.read_back_output_image()
+
+    def write_output_bits(self, changes):
+        #"""
+        #Applies bit changes to the output image and writes the bits which changed with one request (see set_output_register()).
+        #If no bit changes, nothing is written and the write is counted in suppressed_writes. Has to be called while self.sem is held.
+
+        #:param changes List of (index, nr, value), see set_output_image_bit()
+        #:returns True if something was written
+        #:rtype bool
+        #"""
+        image = self.get_output_image()
+        target = list(image)
+        for index, nr, value in changes:
+            self.set_output_image_bit(target, index, nr, value)
+        if self.stop_latched:
+            target = self.clear_conveyor_bits(target)
+
+        changed = [offset for offset in range(self.OUTPUT_REGISTER_COUNT) if target[offset] != image[offset]]
+        if not changed:
+            self.suppressed_writes += 1
+            return False
+
+        first = changed[0]
+        last = changed[-1] + 1
+        register = self.set_output_register(target[first:last], offset=first, mask=[image[offset] ^ target[offset] for offset in range(first, last)])
+
+        #Bits which this command did not change, but which differ on the Modbus node: the output image was outdated
+        self.reconcile_mismatches += sum(1 for i in range(len(register)) if register[i] != target[first + i])
+        return True
+
+    def clear_homing_bits(self, switch_ids):
+        #"""
+        #Clears the homing bit of the switches which have it set in the output image with one write, so that setting it again
+        #starts a new homing. Switches without homing bit are not written and not counted as suppressed write.
+        #Has to be called while self.sem is held.
+
+        #:param switch_ids List of indices of switches
+        #"""
+        image = self.get_output_image()
+        homing = [(switch_id, 0, False) for switch_id in switch_ids
+                  if test_bit(image[self.get_offset(self.INDEX.get(switch_id)[0])], self.get_bit(switch_id, 0))]
+        if homing:
+            self.write_output_bits(homing)
+
+    def clear_conveyor_bits(self, register, offset = 0):
+        #"""
+        #Clears the bits for forward/backward of all conveyors in a list of output registers.
+
+        #:param register List of output registers
+        #:param offset Offset of the first register to the DIGITAL_OUTPUT_STARTING_ADDRESS
+        #:returns List of output registers without bits for forward/backward
+        #:rtype list of int
+        #"""
+        register = list(register)
+        for conveyor_id in self.INDEX_CONVEYORS:
+            for nr in range(2):
+                i = self.get_offset(self.INDEX.get(conveyor_id)[nr]) - offset
+                if 0 <= i < len(register):
+                    register[i] = reset_bit(register[i], self.get_bit(conveyor_id, nr))
+        return register
+
+    def restore_switch_bits(self, register):
+        #"""
+        #Sets the bits of the switches in a list of output registers (offset 0 - 3) as they were last commanded (see commanded_registers).
+
+        #:param register List of output registers
+        #:returns List of output registers with the commanded switch bits
+        #:rtype list of int
+        #"""
+        register = list(register)
+        for switch_id in self.INDEX_SWITCHES:
+            for nr in range(4):
+                offset = self.get_offset(self.INDEX.get(switch_id)[nr])
+                commanded = self.commanded_registers.get(offset)
+                if commanded is not None and offset < len(register):
+                    bit = self.get_bit(switch_id, nr)
+                    register[offset] = set_bit(register[offset], bit) if test_bit(commanded, bit) else reset_bit(register[offset], bit)
+        return register
+
+    def stop_request(self, request, *args):
+        #"""
+        #Runs a request of conveyor_stop_all() over stop_client and repeats it if it fails, up to STOP_ATTEMPTS times.
+
+        #:param request Method of stop_client
+        #:param args Arguments of the request
+        #:returns Result of the request
+        #:raises ConnectionError if the request failed STOP_ATTEMPTS times
+        #"""
+        for attempt in range(self.STOP_ATTEMPTS):
+            result = request(*args)
+            if result is not None and result is not False:
+                return result
+        raise ConnectionError(f"{request.__name__}{args} failed {self.STOP_ATTEMPTS} times")
 
     def get_offset(self, bit_nr):
         #"""
@@ -181,27 +427,106 @@ class TransportInputModule_Library:
 
         with self.sem:
             # DE
-            # Nötiger Offset wird berechnet um das korrekte word zu adressieren
-            # Da bei den Laufbändern das Bit für Vor/Zurück immer im selben Offset liegen reicht es von einem der Beiden des Offset zu bestimmen
+            # Bits für Vor- und Rückwärts fahren löschen damit das Band anhält (wird nur geschrieben, wenn sich ein Bit ändert)
 
             # ENG
-            # Necessary offset is calculated to address the correct word.
-            # Since the bit for forward/backward of the tapes are always in the same offset, it is sufficient to determine the offset of one of them
+            # Delete bits for forward and reverse so that the tape stops (only written if a bit changes)
+            self.write_output_bits([(conveyor_id, 0, False), (conveyor_id, 1, False)])
 
-            offset = self.get_offset(self.INDEX.get(conveyor_id)[0])
-            bit_forward = self.get_bit(conveyor_id, 0)
-            bit_backward = self.get_bit(conveyor_id, 1)
+    def conveyor_stop_all(self):
+        # DE
+        # Nothalt: Hält alle Laufbänder an, ohne auf self.sem, read_write_sem oder andere Anfragen zu warten.
+        # Die Bits für Vor- und Rückwärts aller Laufbänder werden mit einem Lese- und einem Schreibzugriff über die eigene
+        # Verbindung stop_client gelöscht und danach die analogen Ausgänge für die speed auf 0 gesetzt.
+        # Bis conveyor_release_stop() aufgerufen wird, können die Laufbänder nicht wieder gestartet werden.
+        # :returns Dauer des Nothalts in Sekunden
+        # :rtype float
+        # :raises ConnectionError wenn ein Teil des Nothalts nach STOP_ATTEMPTS Versuchen nicht geschrieben werden konnte
 
-            reg = self.get_output_register(offset)
-            # DE
-            # Bits für Vor- und Rückwärts fahren löschen damit das Band anhält
+        # ENG
+        # Emergency stop: Stops all conveyors without waiting for self.sem, read_write_sem or other requests.
+        # The bits for forward and reverse of all conveyors are cleared with one read and one write over the own
+        # connection stop_client, afterwards the analog outputs for the speed are set to 0.
+        # The conveyors cannot be started again until conveyor_release_stop() is called.
+        # :returns duration of the emergency stop in seconds
+        # :rtype float
+        # :raises ConnectionError if a part of the emergency stop could not be written within STOP_ATTEMPTS attempts
+
+        start = perf_counter()
+        self.stop_latched = True
+        failures = []
 
-            # ENG
-            # Delete bits for forward and reverse so that the tape stops
-            reg[0] = reset_bit(reg[0], bit_forward)
-            reg[0] = reset_bit(reg[0], bit_backward)
+        # DE
+        # Alle Ausgangsregister mit Bits für Laufbänder (Offset 0 - 3) auf einmal lesen und schreiben. Die Bits der Weichen werden
+        # so geschrieben, wie sie zuletzt kommandiert wurden. Lesen und Schreiben werden wiederholt, solange währenddessen ein
+        # Schreibzugriff von set_output_register() lief oder begonnen wurde, damit dieser weder die Weichen zurückstellt noch ein Laufband startet.
+
+        # ENG
+        # Read and write all output registers with bits for conveyors (offset 0 - 3) at once. The bits of the switches are
+        # written as they were last commanded. Read and write are repeated as long as a write of set_output_register() was
+        # in progress or started meanwhile, so that it neither resets the switches nor restarts a conveyor.
+        try:
+            while True:
+                started_writes = self.started_writes
+                finished_writes = self.finished_writes
+                reg = self.stop_request(self.stop_client.read_holding_registers, self.DIGITAL_OUTPUT_STARTING_ADDRESS, self.OUTPUT_REGISTER_COUNT)
+                reg = self.restore_switch_bits(self.clear_conveyor_bits(reg))
+                self.stop_request(self.stop_client.write_multiple_registers, self.DIGITAL_OUTPUT_STARTING_ADDRESS, reg)
+                if started_writes == finished_writes == self.started_writes == self.finished_writes:
+                    break
+        except ConnectionError as error:
+            failures.append(str(error))
+
+        # DE
+        # Das Ausgangsabbild wurde an self.sem vorbei verändert und wird deshalb vor der nächsten Verwendung zurückgelesen.
+        # Lese- und Schreibzugriffe, die vorher begonnen haben, dürfen es nicht mehr setzen (siehe output_image_generation)
+
+        # ENG
+        # The output image was changed past self.sem and is therefore read back before its next use.
+        # Reads and writes which started before must not set it anymore (see output_image_generation)
+        with self.image_lock:
+            self.output_image_generation += 1
+            self.output_image = None
+
+        # DE
+        # speed auf 0 setzen, dabei werden die vier Werte je Schritt mit einem Schreibzugriff geschrieben statt mit vier (siehe write_conveyor_speed_block())
+
+        # ENG
+        # Set speed to 0, the four values per step are written with one write instead of four (see write_conveyor_speed_block())
+        self.speed_stops_started += 1
+        updates = (self.speed_updates_started, self.speed_updates_finished)
+        for conveyor_id in self.INDEX_CONVEYORS:
+            self.conveyor_speed[conveyor_id] = 0
+        speed_failures = 0
+        for control, first_value, first_conveyors, second_conveyors in self.SPEED_MODULES:
+            try:
+                self.write_conveyor_speed_block(self.stop_client, control, first_value, first_conveyors, second_conveyors, request=self.stop_request)
+            except ConnectionError as error:
+                speed_failures += 1
+                failures.append(str(error))
+
+        self.speed_stops_finished += 1
+
+        # DE
+        # Ist das Schreiben der speed fehlgeschlagen oder lief währenddessen update_conveyor_speed(), ist sie auf dem Modbus-Knoten
+        # unbekannt und wird beim nächsten Mal geschrieben
+
+        # ENG
+        # If writing the speed failed or update_conveyor_speed() was running meanwhile, it is unknown on the Modbus node and
+        # is written the next time
+        self.conveyor_speed_written = speed_failures == 0 and updates[0] == updates[1] == self.speed_updates_started
+        if failures:
+            raise ConnectionError("Emergency stop failed: " + "; ".join(failures))
 
-            self.set_output_register(reg, offset)
+        return perf_counter() - start
+
+    def conveyor_release_stop(self):
+        # DE
+        # Hebt den Nothalt von conveyor_stop_all() auf, danach können die Laufbänder wieder gestartet werden.
+
+        # ENG
+        # Releases the emergency stop of conveyor_stop_all(), afterwards the conveyors can be started again.
+        self.stop_latched = False
 
     def conveyor_forward(self, conveyor_id):
         # DE
@@ -216,26 +541,11 @@ class TransportInputModule_Library:
 
         with self.sem:
             # DE
-            # #Nötiger Offset wird berechnet um das korrekte word zu adressieren
-            # #Da bei den Laufbändern das Bit für Vor/Zurück immer im selben Offset liegen reicht es von einem der Beiden des Offset zu bestimmen
-
-            # ENG
-            # #Necessary offset is calculated to address the correct word.
-            # #Since the bit for forward/backward of the tapes are always in the same offset, it is sufficient to determine the offset of one of them
-            offset = self.get_offset(self.INDEX.get(conveyor_id)[0])
-            bit_forward = self.get_bit(conveyor_id, 0)
-            bit_backward = self.get_bit(conveyor_id, 1)
-            
-            reg = self.get_output_register(offset)
-            # DE
-            # Bit für Vorwärts setzen und Bit für Rückwärts löschen
+            # Bit für Vorwärts setzen und Bit für Rückwärts löschen (wird nur geschrieben, wenn sich ein Bit ändert)
 
             # ENG
-            # Set bit for forward and clear bit for reverse
-            reg[0] = set_bit(reg[0], bit_forward)
-            reg[0] = reset_bit(reg[0], bit_backward)
-
-            self.set_output_register(reg, offset)
+            # Set bit for forward and clear bit for reverse (only written if a bit changes)
+            self.write_output_bits([(conveyor_id, 0, True), (conveyor_id, 1, False)])
 
     def conveyor_backward(self, conveyor_id):
         # DE
@@ -249,104 +559,73 @@ class TransportInputModule_Library:
         # :param conveyor_id the index of the conveyor as character (see hardware documentation chapter 2.1.4)
         with self.sem:
             # DE
-            # Nötiger Offset wird berechnet um das korrekte word zu adressieren
-            # Da bei den Laufbändern das Bit für Vor/Zurück immer im selben Offset liegen reicht es von einem der Beiden des Offset zu bestimmen
-            # ENG
-            # Necessary offset is calculated to address the correct word.
-            # Since the bit for forward/backward of the tapes are always in the same offset, it is sufficient to determine the offset of one of them
-            offset = self.get_offset(self.INDEX.get(conveyor_id)[0])
-            bit_forward = self.get_bit(conveyor_id, 0)
-            bit_backward = self.get_bit(conveyor_id, 1)
-            
-            reg = self.get_output_register(offset)
-            # DE
-            # Bit für Vorwärts löschen und Bit für Rückwärts setzen
+            # Bit für Vorwärts löschen und Bit für Rückwärts setzen (wird nur geschrieben, wenn sich ein Bit ändert)
 
             # ENG
-            # Clear bit for forward and set bit for reverse
-            reg[0] = reset_bit(reg[0], bit_forward)
-            reg[0] = set_bit(reg[0], bit_backward)
-
-            self.set_output_register(reg, offset)
+            # Clear bit for forward and set bit for reverse (only written if a bit changes)
+            self.write_output_bits([(conveyor_id, 0, False), (conveyor_id, 1, True)])
 
     def set_switch(self, weiche_index, pos = 0):
         # DE
-        # Stellt die Weiche, die über weiche_index angegeben wurde, auf die Position pos, indem erst alle Bits für die Positionen gelöscht werden und
-        # danach das Bit für die Position pos gesetzt wird.
+        # Stellt die Weiche, die über weiche_index angegeben wurde, auf die Position pos, indem alle anderen Bits für die Positionen gelöscht werden und
+        # das Bit für die Position pos gesetzt wird.
         # :param weiche_index der Index der Weiche als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
         # :param pos Position auf welche die Weiche gestellt werden (pos = 0 löst Referenzfahrt aus)
 
         # ENG
-        # Sets the switch, which was specified via switch_index, to the position pos, by first clearing all bits for the positions and
-        # then setting the bit for position pos.
+        # Sets the switch, which was specified via switch_index, to the position pos, by clearing all other bits for the positions and
+        # setting the bit for position pos.
         # :param switch_index the index of the switch as character (see hardware documentation chapter 2.1.4)
         # :param pos position to which the turnout is set (pos = 0 triggers homing)
 
         with self.sem:
-            # DE
-            # Da bei einigene Weichen die Bits zur ansteuerung einer Weiche unterschiedliche Offsets haben muss hier zu jedem Bit der eigene Offset berechnet werden.
-
-            # ENG
-            # Since the bits for controlling a turnout have different offsets in some turnouts, the offset must be calculated for each bit.
-            offset = [
-                self.get_offset(self.INDEX.get(weiche_index)[0]), #Referenz Fahrt
-                self.get_offset(self.INDEX.get(weiche_index)[1]), #Position 1
-                self.get_offset(self.INDEX.get(weiche_index)[2]), #Position 2
-                self.get_offset(self.INDEX.get(weiche_index)[3])  #Position 3
-            ]
-            bit = [
-                self.get_bit(weiche_index, 0), #Referenz Fahrt
-                self.get_bit(weiche_index, 1), #Position 1
-                self.get_bit(weiche_index, 2), #Position 2
-                self.get_bit(weiche_index, 3)  #Position 3
-            ]
             #DE
-            #Löscht alle Bits zur Weichenstellung (wenn 2 oder mehr Bits gleichzeitig gesetzt wären, wäre nicht eindeutig welche Position die weiche einnehmen soll)
+            #Löscht alle anderen Bits zur Weichenstellung (wenn 2 oder mehr Bits gleichzeitig gesetzt wären, wäre nicht eindeutig welche Position die weiche einnehmen soll)
+            #und setzt das Bit, dass die Weiche an die Position pos fährt. Alle Bits werden zusammen geschrieben, so dass eine Weiche,
+            #die schon auf pos steht, nicht kurz ohne Position ist; steht sie schon auf pos, wird nichts geschrieben.
+            #Die Referenzfahrt (pos = 0) startet mit dem Setzen des Bits, deshalb wird es zuerst gelöscht, wenn es noch gesetzt ist, damit auch eine wiederholte Referenzfahrt geschrieben wird.
 
             #ENG
-            #Clears all bits for switch setting (if 2 or more bits were set at the same time, it would not be clear which position the switch should take)
-            for i in range(4):
-                reg = self.get_output_register(offset=offset[i])
-                reg[0] = reset_bit(reg[0], bit[i])
-                self.set_output_register(reg, offset=offset[i])
-
-            #DE
-            #Setzt das Bit, dass die Weiche an die Position pos fährt
-
-            #ENG
-            #Sets the bit that the switch moves to position pos
-            reg = self.get_output_register(offset=offset[pos])
-            reg[0] = set_bit(reg[0], bit[pos])
-            self.set_output_register(reg, offset=offset[pos])
-
-    def check_conveyor_workpiece_begin(self, conveyor_id):
+            #Clears all other bits for switch setting (if 2 or more bits were set at the same time, it would not be clear which position the switch should take)
+            #and sets the bit that the switch moves to position pos. All bits are written together, so that a switch which is
+            #already at pos is not without position for a moment; if it is already at pos, nothing is written.
+            #Homing (pos = 0) is started by setting the bit, so if it is still set, it is cleared first and a repeated homing is written as well.
+            if pos == 0:
+                self.clear_homing_bits([weiche_index])
+            self.write_output_bits([(weiche_index, nr, nr == pos) for nr in range(4)])
+
+    def check_conveyor_workpiece_begin(self, conveyor_id, image = None):
         #DE
         #Überprüft, ob der Sensor am Anfang des Laufbandes, welches mit conveyor_id angegeben wurde, ein Werkstück erkennt.
         #:param conveyor_id der Index des Laufbands als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob der Sensor ein Werkstück erkennt
         #:rtype bool
 
         #ENG
         #Checks if the sensor detects a workpiece at the beginning of the conveyor specified by conveyor_id.
         #:param conveyor_id the index of the conveyor as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether the sensor detects a workpiece
         #:rtype bool
 
         offset = self.get_offset(self.INDEX.get(conveyor_id)[0])
         bit_sensor_anfang = self.get_bit(conveyor_id, 0)
 
-        return test_bit(self.get_input_register(offset)[0], bit_sensor_anfang)
+        return test_bit(self.get_input_word(offset, image), bit_sensor_anfang)
 
-    def check_conveyor_workpiece_end(self, conveyor_id):
+    def check_conveyor_workpiece_end(self, conveyor_id, image = None):
         #DE
         #Überprüft, ob der Sensor am Ende des Laufbandes, welches mit conveyor_id angegeben wurde, ein Werkstück erkennt.
         #:param conveyor_id der Index des Laufbands als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob der Sensor ein Werkstück erkennt
         #:rtype bool
 
         #ENG
         #Checks if the sensor detects a workpiece at the end of the conveyor specified by conveyor_id.
         #:param conveyor_id the index of the conveyor as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether the sensor detects a workpiece
         #:rtype bool
 
@@ -354,69 +633,76 @@ class TransportInputModule_Library:
         offset = self.get_offset(self.INDEX.get(conveyor_id)[1])
         bit_sensor_ende = self.get_bit(conveyor_id, 1)
 
-        return test_bit(self.get_input_register(offset)[0], bit_sensor_ende)
+        return test_bit(self.get_input_word(offset, image), bit_sensor_ende)
 
-    def check_switch_position_reached(self, weiche_index):
+    def check_switch_position_reached(self, weiche_index, image = None):
         #DE
         #Überprüft, ob die Weiche, welche mit weiche_index angegeben wurde, die gewünschte Position erreicht hat.
         #:param weiche_index der Index der Weiche als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob die weiche die Position erreicht hat
         #:rtype bool
 
         #ENG
         #Checks if the turnout specified with turnout_index has reached the desired position.
         #:param weiche_index the index of the turnout as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean if the switch has reached the position
         #:rtype bool
 
         offset = self.get_offset(self.INDEX.get(weiche_index)[0])
         bit_pos_erreicht = self.get_bit(weiche_index, 0)
 
-        return test_bit(self.get_input_register(offset)[0], bit_pos_erreicht)
+        return test_bit(self.get_input_word(offset, image), bit_pos_erreicht)
 
-    def check_switch_in_movement(self, weiche_index):
+    def check_switch_in_movement(self, weiche_index, image = None):
         #DE
         #Überprüft, ob die Weiche, welche mit weiche_index angegeben wurde, in Bewegung ist.
         #:param weiche_index der Index der Weiche als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob die Weiche in Bewegung ist
         #:rtype bool
 
         #ENG
         #Checks if the turnout specified with turnout_index is in motion.
         #:param turnout_index the index of the turnout as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether the switch is in motion
         #:rtype bool
        
         offset = self.get_offset(self.INDEX.get(weiche_index)[1])
         bit_in_bewegung = self.get_bit(weiche_index, 1)
 
-        return test_bit(self.get_input_register(offset)[0], bit_in_bewegung)
+        return test_bit(self.get_input_word(offset, image), bit_in_bewegung)
 
-    def check_switch_workpiece(self, weiche_index):
+    def check_switch_workpiece(self, weiche_index, image = None):
         
         #DE
         #Überprüft, ob sich in der Weiche, welche mit weiche_index angegeben wurde, ein Werkstueck befindet.
         #:param weiche_index der Index der Weiche als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob sich in der Weiche ein Werkstueck befindet
         #:rtype bool      
 
         #ENG
         #Checks if there is a workpiece in the turnout specified with turnout_index.
         #:param weiche_index the index of the turnout as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether there is a workpiece in the switch
         #:rtype bool
     
         offset = self.get_offset(self.INDEX.get(weiche_index)[2])
         bit_werkstueck = self.get_bit(weiche_index, 2)
 
-        return test_bit(self.get_input_register(offset)[0], bit_werkstueck)
+        return test_bit(self.get_input_word(offset, image), bit_werkstueck)
 
-    def check_switch_in_reference_position(self, weiche_index):
+    def check_switch_in_reference_position(self, weiche_index, image = None):
 
         #DE
         #Überprüft das Bit für die Referenzposition, kann aber nicht verwendet werden um Ende der Referenzfahrt zu ermitteln.
         #Methode wurde nur Vollständigkeitshalber implementiert.
         #:param weiche_index der Index der Weiche als Character (Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean das Bit für die Referenzposition gesetzt ist
         #:rtype bool
 
@@ -424,61 +710,70 @@ class TransportInputModule_Library:
         #Checks the bit for the reference position, but cannot be used to determine the end of the reference run.
         #Method was implemented only for completeness.
         #:param turnout_index the index of the turnout as character (see hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean the bit for the reference position is set
         #:rtype bool
 
         offset = self.get_offset(self.INDEX.get(weiche_index)[3])
         bit_referenzposition = self.get_bit(weiche_index, 3)
 
-        return test_bit(self.get_input_register(offset)[0], bit_referenzposition)
+        return test_bit(self.get_input_word(offset, image), bit_referenzposition)
 
-    def check_sensor_conveyor_workstations_back(self, conveyor_id):
+    def check_sensor_conveyor_workstations_back(self, conveyor_id, image = None):
         
         #DE
         #Überprüft, ob von dem Sensor hinter dem Auswurf der Bearbeitungsstation ein Werkstück erkannt wird.
         #:param conveyor_id der Index des Laufbands als Character (Nur B und R haben diese Sensoren! Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob von dem Sensor ein Werkstück erkannt wird
         #:rtype bool
 
         #ENG
         #Checks whether a workpiece is detected by the sensor behind the ejector of the processing station.
         #:param conveyor_id the index of the conveyor as character (Only B and R have these sensors! See hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether a workpiece is detected by the sensor
         #:rtype bool
 
         offset = self.get_offset(self.INDEX.get(conveyor_id)[2])
         bit_werkstueck_hinten = self.get_bit(conveyor_id, 2)
 
-        return test_bit(self.get_input_register(offset)[0], bit_werkstueck_hinten)
+        return test_bit(self.get_input_word(offset, image), bit_werkstueck_hinten)
 
-    def check_sensor_conveyor_workstations_front(self, conveyor_id):
+    def check_sensor_conveyor_workstations_front(self, conveyor_id, image = None):
         
         #DE
         #Überprüft, ob von dem Sensor vor dem Auswurf der Bearbeitungsstation ein Werkstück erkannt wird.
         #:param conveyor_id der Index des Laufbands als Character (Nur B und R haben diese Sensoren! Siehe Hardwaredokumentation Kapitel 2.1.4)
+        #:param image Eingangsabbild von get_input_image() (bei None wird das Register einzeln gelesen)
         #:returns boolean ob von dem Sensor ein Werkstück erkannt wird
         #:rtype bool
 
         #ENG
         #Checks if a workpiece is detected by the sensor before the ejection of the processing station.
         #:param conveyor_id the index of the conveyor as character (Only B and R have these sensors! See hardware documentation chapter 2.1.4)
+        #:param image input image from get_input_image() (if None, the register is read on its own)
         #:returns boolean whether a workpiece is detected by the sensor
         #:rtype bool
 
         offset = self.get_offset(self.INDEX.get(conveyor_id)[3])
         bit_werkstueck_hinten = self.get_bit(conveyor_id, 3)
 
-        return test_bit(self.get_input_register(offset)[0], bit_werkstueck_hinten)
+        return test_bit(self.get_input_word(offset, image), bit_werkstueck_hinten)
 
     def update_conveyor_speed(self):
         
         #DE
-        #Setzt die Analogen Ausgänge zum regeln der Laufbandspeed auf die Werte, die in der Map self.conveyor_speed angegeben werden.
+        #Setzt die Analogen Ausgänge zum regeln der Laufbandspeed auf die Werte, die in der Map self.conveyor_speed angegeben werden
+        #(je Analogmodul ein write_conveyor_speed_block()).
 
         #ENG
-        #Sets the analog outputs for controlling the conveyor speed to the values specified in the map self.conveyor_speed.
+        #Sets the analog outputs for controlling the conveyor speed to the values specified in the map self.conveyor_speed
+        #(one write_conveyor_speed_block() per analog module).
 
         with self.read_write_sem:
+            self.speed_updates_started += 1
+            stops = (self.speed_stops_started, self.speed_stops_finished)
 
             #DE
             #Automatisches öffnen und schließen von TCP verbindungen aufheben, da hier viele TCP Pakete nacheinander gesendet werden
@@ -499,43 +794,9 @@ class TransportInputModule_Library:
 
             self.client.open()
 
-            self.client.write_single_register(8024, int("0x6000",16))
-            self.client.write_single_register(8024, int("0x3000",16))
-
-            self.client.write_single_register(8025, self.conveyor_speed.get('A'))
-            self.client.write_single_register(8026, self.conveyor_speed.get('B'))
-            self.client.write_single_register(8027, self.conveyor_speed.get('C'))
-            self.client.write_single_register(8028, self.conveyor_speed.get('D'))
+            for control, first_value, first_conveyors, second_conveyors in self.SPEED_MODULES:
+                self.write_conveyor_speed_block(self.client, control, first_value, first_conveyors, second_conveyors)
 
-            self.client.write_single_register(8024, int("0x0100",16))
-            self.client.write_single_register(8024, int("0x0b00",16))
-
-            self.client.write_single_register(8025, self.conveyor_speed.get('H'))
-            self.client.write_single_register(8026, self.conveyor_speed.get('I'))
-            self.client.write_single_register(8027, self.conveyor_speed.get('J'))
-            self.client.write_single_register(8028, self.conveyor_speed.get('L'))
-
-            self.client.write_single_register(8024, int("0x0900",16))
-
-
-            self.client.write_single_register(8029, int("0x6000",16))
-            self.client.write_single_register(8029, int("0x3000",16))
-
-            self.client.write_single_register(8030, self.conveyor_speed.get('M'))
-            self.client.write_single_register(8031, self.conveyor_speed.get('P'))
-            self.client.write_single_register(8032, self.conveyor_speed.get('Q'))
-            self.client.write_single_register(8033, self.conveyor_speed.get('R'))
-
-            self.client.write_single_register(8029, int("0x0100",16))
-            self.client.write_single_register(8029, int("0x0b00",16))
-
-            self.client.write_single_register(8030, self.conveyor_speed.get('U'))
-            self.client.write_single_register(8031, self.conveyor_speed.get('V'))
-            self.client.write_single_register(8032, 0)
-            self.client.write_single_register(8033, 0)
-
-            self.client.write_single_register(8029, int("0x0900",16))
-            
             #DE
             #Schließen der TCP Verbindung
 
@@ -547,6 +808,38 @@ class TransportInputModule_Library:
             self.client.auto_close = True
             self.client.auto_open = True
 
+            #DE
+            #Lief währenddessen der Nothalt, können sich die Schreibzugriffe auf die Steuerregister vermischt haben
+
+            #ENG
+            #If the emergency stop was running meanwhile, the writes to the control registers may have been interleaved
+            self.speed_updates_finished += 1
+            self.conveyor_speed_written = stops[0] == stops[1] == self.speed_stops_started
+
+    def write_conveyor_speed_block(self, client, control, first_value, first_conveyors, second_conveyors, request = None):
+        #"""
+        #Writes the speeds of self.conveyor_speed to one analog module (see SPEED_MODULES). The four values of each step are
+        #written with one request instead of four single writes, so one module needs 7 requests.
+
+        #:param client ModbusClient which sends the requests
+        #:param control Address of the control register of the module
+        #:param first_value Address of the first of the four value registers of the module
+        #:param first_conveyors Conveyors of the first four values
+        #:param second_conveyors Conveyors of the second four values (missing values are written as 0)
+        #:param request Function (client method, arguments...) which sends a request, e.g. stop_request() (None = send it once)
+        #"""
+        if request is None:
+            request = lambda method, *args: method(*args)
+        values = lambda conveyors: [self.conveyor_speed.get(conveyor_id) for conveyor_id in conveyors] + [0] * (4 - len(conveyors))
+
+        request(client.write_single_register, control, int("0x6000",16))
+        request(client.write_single_register, control, int("0x3000",16))
+        request(client.write_multiple_registers, first_value, values(first_conveyors))
+        request(client.write_single_register, control, int("0x0100",16))
+        request(client.write_single_register, control, int("0x0b00",16))
+        request(client.write_multiple_registers, first_value, values(second_conveyors))
+        request(client.write_single_register, control, int("0x0900",16))
+
     def set_conveyor_speed(self, conveyor_id, speed):
         
         #DE
@@ -560,6 +853,14 @@ class TransportInputModule_Library:
         #:param speed speed of the conveyor as integer between 0 (0%/0V) and 30000 (100%/10V)
 
         with self.sem:
+            #DE
+            #Unveränderte speed wird nicht erneut geschrieben
+
+            #ENG
+            #An unchanged speed is not written again
+            if self.conveyor_speed_written and self.conveyor_speed[conveyor_id] == speed:
+                self.suppressed_writes += 1
+                return
             self.conveyor_speed[conveyor_id] = speed
             self.update_conveyor_speed()
 
@@ -574,6 +875,105 @@ class TransportInputModule_Library:
         # :param speed speed of the treadmills as integer between 0 (0%/0V) and 30000 (100%/10V).
 
         with self.sem:
+            if self.conveyor_speed_written and all(self.conveyor_speed[i] == speed for i in self.INDEX_CONVEYORS):
+                self.suppressed_writes += 1
+                return
             for i in self.INDEX_CONVEYORS:
                 self.conveyor_speed[i] = speed
             self.update_conveyor_speed()
+
+    def set_output_image_bit(self, image, index, nr, value):
+        #DE
+        #Setzt oder löscht ein Ausgangsbit in einem Ausgangsabbild (Register Offset 0 - 3), ohne etwas zu schreiben.
+        #:param image Liste der Ausgangsregister, indiziert über den Offset
+        #:param index Index des Laufbands oder der Weiche als Character
+        #:param nr Nummer der Funktion des Bits (siehe Kommentare in der INDEX Map)
+        #:param value True setzt das Bit, False löscht es
+
+        #ENG
+        #Sets or clears an output bit in an output image (registers offset 0 - 3) without writing anything.
+        #:param image list of the output registers, indexed by the offset
+        #:param index index of the conveyor or switch as character
+        #:param nr number of the function of the bit (see comments in the INDEX map)
+        #:param value True sets the bit, False clears it
+        offset = self.get_offset(self.INDEX.get(index)[nr])
+        if value:
+            image[offset] = set_bit(image[offset], self.get_bit(index, nr))
+        else:
+            image[offset] = reset_bit(image[offset], self.get_bit(index, nr))
+
+    def execute_batch(self, commands):
+
+        #DE
+        #Führt eine Liste von Befehlen für Laufbänder und Weichen gemeinsam aus. Alle Befehle werden zuerst geprüft, dann auf
+        #das Ausgangsabbild angewendet, das mit einem Schreibzugriff geschrieben wird (siehe write_output_bits()); nur eine
+        #Referenzfahrt braucht einen Schreibzugriff mehr, der das Bit vorher löscht (siehe set_switch()).
+        #Speed Befehle werden gesammelt und mit einem einzigen update_conveyor_speed() geschrieben.
+        #:param commands Liste von (index, aktion, argument):
+        #    Laufband: 'forward', 'backward', 'stop' (argument wird ignoriert) oder 'speed' (argument = speed 0 - 30000)
+        #    Weiche: 'switch' (argument = Position 0 - 3, 0 löst Referenzfahrt aus)
+        #Die speed wird vor den Richtungsbits geschrieben, damit ein Laufband nicht noch mit der alten speed anläuft.
+        #:raises ValueError wenn ein Befehl ungültig ist, dann wird nichts geschrieben
+        #:raises TransportInputModule_Stop_Latched_Error wenn ein Laufband während des Nothalts starten soll, dann wird nichts geschrieben
+
+        #ENG
+        #Executes a list of commands for conveyors and switches together. All commands are checked first, then applied to
+        #the output image, which is written with one write (see write_output_bits()); only homing needs one more write,
+        #which clears the bit before (see set_switch()).
+        #Speed commands are collected and written with a single update_conveyor_speed().
+        #:param commands list of (index, action, argument):
+        #    conveyor: 'forward', 'backward', 'stop' (argument is ignored) or 'speed' (argument = speed 0 - 30000)
+        #    switch: 'switch' (argument = position 0 - 3, 0 triggers homing)
+        #The speed is written before the direction bits, so that a conveyor does not start with the old speed.
+        #:raises ValueError if a command is invalid, nothing is written in this case
+        #:raises TransportInputModule_Stop_Latched_Error if a conveyor is to start during the emergency stop, nothing is written in this case
+
+        for index, action, argument in commands:
+            if index in self.INDEX_CONVEYORS:
+                if action not in ('forward', 'backward', 'stop', 'speed'):
+                    raise ValueError(f"Invalid action {action!r} for conveyor {index!r}")
+                if action == 'speed' and not (type(argument) is int and 0 <= argument <= 30000):
+                    raise ValueError(f"Invalid speed {argument!r} for conveyor {index!r}")
+            elif index in self.INDEX_SWITCHES:
+                if action != 'switch':
+                    raise ValueError(f"Invalid action {action!r} for switch {index!r}")
+                if not (type(argument) is int and 0 <= argument <= 3):
+                    raise ValueError(f"Invalid position {argument!r} for switch {index!r}")
+            else:
+                raise ValueError(f"Unknown conveyor or switch {index!r}")
+
+        with self.sem:
+            digital = [command for command in commands if command[1] != 'speed']
+            speed = [command for command in commands if command[1] == 'speed']
+
+            if self.stop_latched and any(action in ('forward', 'backward') for index, action, argument in digital):
+                raise TransportInputModule_Stop_Latched_Error("Conveyors cannot be started while the emergency stop is latched")
+
+            if speed:
+                if self.conveyor_speed_written and all(self.conveyor_speed[index] == argument for index, action, argument in speed):
+                    self.suppressed_writes += 1
+                else:
+                    for index, action, argument in speed:
+                        self.conveyor_speed[index] = argument
+                    self.update_conveyor_speed()
+
+            if digital:
+                #DE
+                #Wie bei set_switch() wird das Bit für die Referenzfahrt zuerst gelöscht, damit eine wiederholte Referenzfahrt startet
+
+                #ENG
+                #Like in set_switch() the bit for homing is cleared first, so that a repeated homing starts
+                self.clear_homing_bits([index for index, action, argument in digital if action == 'switch' and argument == 0])
+
+                changes = []
+                for index, action, argument in digital:
+                    if action == 'switch':
+                        #DE
+                        #Wie bei set_switch() alle anderen Positionsbits löschen, damit nur eine Position gesetzt ist
+
+                        #ENG
+                        #Like in set_switch() clear all other position bits, so that only one position is set
+                        changes += [(index, nr, nr == argument) for nr in range(4)]
+                    else:
+                        changes += [(index, 0, action == 'forward'), (index, 1, action == 'backward')]
+                self.write_output_bits(changes)
@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+from TransportInputModule_Library import *
+from TransportInputModule_Station import conveyor_data
+from pyModbusTCP.server import ModbusServer, DataBank
+from asyncua import Client, ua
+
+#Load test of the TIM OPC UA server: starts the server against a local Modbus stand-in and runs N concurrent
+#asyncua clients which subscribe to all workpiece/switch variables and call methods at a configurable rate.
+#
+#Example: python TransportInputModule_OPCUA_Load_Test.py --clients 1 2 4 8 16 32 --duration 30 --method-rate 2
+
+URI = "http://examples.freeopcua.github.io"
+METHODS = ["Conveyor_Move_Forward", "Reset_All_Switch"]
+
+_logger = logging.getLogger(__name__)
+
+
+class ModbusStandIn:
+    #Simulates the Modbus node of the transport input module: switches reach the commanded position, workpieces
+    #arrive at the end of the conveyors and run through the switches of the stations in conveyor_data.
+
+    def __init__(self, port, piece_interval = 2.0, tick = 0.02):
+        #"""
+        #constructor of the Modbus stand-in.
+
+        #:param port TCP port on which the stand-in listens on 127.0.0.1
+        #:param piece_interval Seconds between a station getting idle and the next workpiece arriving at its conveyor end
+        #:param tick Period of the plant simulation in seconds
+        #"""
+        self.bank = DataBank()
+        self.server = ModbusServer(host="127.0.0.1", port=port, no_block=True, data_bank=self.bank)
+        self.piece_interval = piece_interval
+        self.tick = tick
+        self.running = False
+
+        #only used for the bit layout (get_offset/get_bit), no connection is opened
+        self.layout = TransportInputModule_Library("127.0.0.1", port=port)
+
+        #station state: 'idle' -> 'at_end' -> 'in_switch' -> 'idle'
+        self.stations = {data[0] : {'state' : 'idle', 'since' : 0.0} for data in conveyor_data}
+
+    def start(self):
+        self.server.start()
+        self.running = True
+        self.thread = threading.Thread(target=self._simulate, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.server.stop()
+
+    def _output_bit(self, index, nr):
+        offset = self.layout.get_offset(self.layout.INDEX.get(index)[nr])
+        register = self.bank.get_holding_registers(self.layout.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, 1)[0]
+        return test_bit(register, self.layout.get_bit(index, nr))
+
+    def _set_input_bit(self, index, nr, value):
+        address = self.layout.DIGITAL_INPUT_STARTING_ADDRESS + self.layout.get_offset(self.layout.INDEX.get(index)[nr])
+        register = self.bank.get_holding_registers(address, 1)[0]
+        bit = self.layout.get_bit(index, nr)
+        register = set_bit(register, bit) if value else reset_bit(register, bit)
+        self.bank.set_holding_registers(address, [register])
+
+    def _switch_position(self, switch_id):
+        #commanded position of the switch or None if no or more than one position bit is set
+        positions = [pos for pos in range(4) if self._output_bit(switch_id, pos)]
+        return positions[0] if len(positions) == 1 else None
+
+    def _simulate(self):
+        while self.running:
+            now = time.monotonic()
+
+            #Switch: position reached as soon as exactly one position bit is commanded
+            for switch_id in self.layout.INDEX_SWITCHES:
+                self._set_input_bit(switch_id, 0, self._switch_position(switch_id) is not None)
+
+            #Stations: workpiece arrives at the conveyor end, moves into the switch at pre position and leaves it at post position
+            for conveyor_name, switch_name, next_conveyor_name, switch_pre_pos, switch_post_pos in conveyor_data:
+                station = self.stations[conveyor_name]
+                position = self._switch_position(switch_name)
+                if station['state'] == 'idle' and now - station['since'] >= self.piece_interval:
+                    self._set_input_bit(conveyor_name, 1, True)
+                    station['state'] = 'at_end'
+                elif station['state'] == 'at_end' and position == switch_pre_pos:
+                    self._set_input_bit(conveyor_name, 1, False)
+                    self._set_input_bit(switch_name, 2, True)
+                    station['state'] = 'in_switch'
+                elif station['state'] == 'in_switch' and position == switch_post_pos:
+                    self._set_input_bit(switch_name, 2, False)
+                    station['state'] = 'idle'
+                    station['since'] = now
+
+            time.sleep(self.tick)
+
+
+class ProcessCpu:
+    #CPU usage of the server process, read from /proc (Linux only, otherwise None)
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.reset()
+
+    def cpu_seconds(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat_file:
+                #utime and stime are field 14 and 15, the command name in field 2 may contain spaces
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self.ticks_per_second
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def reset(self):
+        self.start_cpu = self.cpu_seconds()
+        self.start_wall = time.monotonic()
+
+    def percent(self):
+        #:returns CPU usage since the last reset() in percent of one core or None if it cannot be determined
+        cpu = self.cpu_seconds()
+        if cpu is None or self.start_cpu is None:
+            return None
+        return 100.0 * (cpu - self.start_cpu) / max(time.monotonic() - self.start_wall, 1e-9)
+
+
+class SubscriptionHandler:
+    #Collects publish latency and the value changes of one client. Only changes whose SourceTimestamp is within the
+    #measurement window shared by all clients are collected, so that every client is compared over the same changes.
+
+    def __init__(self, window):
+        #:param window dict with 'start' and 'end' (UTC datetime) of the measurement window, empty until the window starts
+        self.window = window
+        self.latencies = []
+        #node id -> set of (SourceTimestamp, value) of the changes within the window
+        self.changes = {}
+        self.status_changes = 0
+
+    def datachange_notification(self, node, val, data):
+        value = data.monitored_item.Value
+        timestamp = value.SourceTimestamp
+        if timestamp is None or not self.window:
+            return
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        #the initial value of each node has the timestamp of its last write, which is before the window
+        if not self.window['start'] <= timestamp < self.window['end']:
+            return
+
+        self.changes.setdefault(node.nodeid.to_string(), set()).add((timestamp, repr(val)))
+        self.latencies.append((datetime.now(timezone.utc) - timestamp).total_seconds())
+
+    def status_change_notification(self, status):
+        self.status_changes += 1
+
+
+async def wait_for_server(url, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        client = Client(url=url)
+        try:
+            await client.connect()
+            await client.disconnect()
+            return
+        except (OSError, asyncio.TimeoutError, ua.UaError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def run_client(url, method_rate, publishing_interval, queue_size, started, window):
+    #"""
+    #Runs one client: subscribes to all workpiece_at_conveyor_*/position_of_switch_* variables and calls the methods
+    #in METHODS alternately with method_rate calls per second until the end of the shared measurement window.
+
+    #:returns (SubscriptionHandler, {method: [latency in seconds]}, number of failed calls)
+    #"""
+    handler = SubscriptionHandler(window)
+    method_latencies = {method : [] for method in METHODS}
+    errors = 0
+
+    async with Client(url=url) as client:
+        idx = await client.get_namespace_index(URI)
+        objects = client.nodes.objects
+        nodes = []
+        for conveyor_id in TransportInputModule_Library.INDEX_CONVEYORS:
+            nodes.append(await objects.get_child([f"{idx}:conveyor_{conveyor_id}", f"{idx}:workpiece_at_conveyor_{conveyor_id}"]))
+        for switch_id in TransportInputModule_Library.INDEX_SWITCHES:
+            nodes.append(await objects.get_child([f"{idx}:switch_{switch_id}", f"{idx}:position_of_switch_{switch_id}"]))
+        tim_server = await objects.get_child(f"{idx}:TIM_Server")
+
+        subscription = await client.create_subscription(publishing_interval, handler)
+        #the queue keeps changes within one publishing interval apart instead of merging them into the latest value
+        await subscription.subscribe_data_change(nodes, queuesize=queue_size)
+
+        #all clients start to call methods at the same time and measure over the same window
+        await started.wait()
+        end = window['end_monotonic']
+        call = 0
+        next_call = time.monotonic()
+        while time.monotonic() < end:
+            if method_rate > 0:
+                method = METHODS[call % len(METHODS)]
+                begin = time.perf_counter()
+                try:
+                    await tim_server.call_method(f"{idx}:{method}")
+                    method_latencies[method].append(time.perf_counter() - begin)
+                except (ua.UaError, asyncio.TimeoutError):
+                    errors += 1
+                call += 1
+                next_call += 1.0 / method_rate
+                await asyncio.sleep(max(0.0, next_call - time.monotonic()))
+            else:
+                await asyncio.sleep(min(1.0, end - time.monotonic()))
+
+        #give the last publish responses time to arrive
+        await asyncio.sleep(2 * publishing_interval / 1000.0)
+        await subscription.delete()
+
+    return handler, method_latencies, errors
+
+
+def percentiles(values):
+    #:returns dict with count, p50, p95, p99 and max of values in milliseconds
+    if not values:
+        return {'count' : 0, 'p50' : None, 'p95' : None, 'p99' : None, 'max' : None}
+    ordered = sorted(values)
+    pick = lambda q: 1000.0 * ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'count' : len(ordered), 'p50' : pick(0.5), 'p95' : pick(0.95), 'p99' : pick(0.99), 'max' : 1000.0 * ordered[-1]}
+
+
+async def run_level(url, clients, duration, method_rate, publishing_interval, queue_size, cpu):
+    started = asyncio.Event()
+    window = {}
+    tasks = [asyncio.create_task(run_client(url, method_rate, publishing_interval, queue_size, started, window)) for _ in range(clients)]
+
+    #wait until all clients are connected and subscribed before measuring
+    await asyncio.sleep(min(5.0, 0.2 * clients + 1.0))
+    cpu.reset()
+    start = datetime.now(timezone.utc)
+    window.update({'start' : start, 'end' : start + timedelta(seconds=duration), 'end_monotonic' : time.monotonic() + duration})
+    started.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    server_cpu = cpu.percent()
+
+    failed_clients = [result for result in results if isinstance(result, BaseException)]
+    results = [result for result in results if not isinstance(result, BaseException)]
+    for failure in failed_clients:
+        _logger.warning("Client failed: %r", failure)
+
+    #every client subscribes to the same nodes during the whole window, so a change (identified by its SourceTimestamp)
+    #which reached any client but not this one was dropped for this client
+    expected = {}
+    for handler, method_latencies, errors in results:
+        for name, changes in handler.changes.items():
+            expected.setdefault(name, set()).update(changes)
+    dropped = sum(len(expected[name] - handler.changes.get(name, set())) for handler, method_latencies, errors in results for name in expected)
+
+    report = {
+        'clients' : clients,
+        'failed_clients' : len(failed_clients),
+        'server_cpu_percent' : server_cpu,
+        'publish_latency_ms' : percentiles([latency for handler, method_latencies, errors in results for latency in handler.latencies]),
+        'changes' : sum(len(changes) for changes in expected.values()),
+        'dropped_notifications' : dropped,
+        'status_changes' : sum(handler.status_changes for handler, method_latencies, errors in results),
+        'method_errors' : sum(errors for handler, method_latencies, errors in results),
+    }
+    for method in METHODS:
+        report[f"{method}_latency_ms"] = percentiles([latency for handler, method_latencies, errors in results for latency in method_latencies[method]])
+    return report
+
+
+def print_report(report):
+    def fmt(value):
+        return "   n/a" if value is None else f"{value:6.1f}"
+
+    print(f"--- {report['clients']} clients ({report['failed_clients']} failed), server CPU {fmt(report['server_cpu_percent'])} %")
+    for name in ['publish_latency_ms'] + [f"{method}_latency_ms" for method in METHODS]:
+        stats = report[name]
+        print(f"    {name:36s} n={stats['count']:6d} p50={fmt(stats['p50'])} p95={fmt(stats['p95'])} p99={fmt(stats['p99'])} max={fmt(stats['max'])}")
+    print(f"    changes {report['changes']}, dropped notifications {report['dropped_notifications']}, status changes {report['status_changes']}, method errors {report['method_errors']}")
+
+
+async def run(args, url, cpu):
+    await wait_for_server(url, timeout=30)
+    reports = []
+    limit = None
+    for clients in args.clients:
+        report = await run_level(url, clients, args.duration, args.method_rate, args.publishing_interval, args.queue_size, cpu)
+        print_report(report)
+        reports.append(report)
+
+        p95 = [report[f"{method}_latency_ms"]['p95'] for method in METHODS] + [report['publish_latency_ms']['p95']]
+        over_budget = any(value is not None and value > args.latency_budget for value in p95)
+        if limit is None and (over_budget or report['dropped_notifications'] > 0 or report['failed_clients'] > 0):
+            limit = clients
+    if limit is None:
+        print(f"No scaling limit reached (p95 budget {args.latency_budget} ms)")
+    else:
+        print(f"Scaling limit reached at {limit} clients (p95 budget {args.latency_budget} ms, drops or failed clients)")
+    return reports
+
+
+def main ():
+    parser = argparse.ArgumentParser(description="Multi-client load test of the TIM OPC UA server against a local Modbus stand-in")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="numbers of concurrent clients to test one after another")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per client level")
+    parser.add_argument("--method-rate", type=float, default=1.0, help="method calls per second and client (0 = subscriptions only)")
+    parser.add_argument("--publishing-interval", type=float, default=100.0, help="publishing interval of the subscriptions in ms")
+    parser.add_argument("--queue-size", type=int, default=10, help="queue size of the monitored items (changes kept per publishing interval)")
+    parser.add_argument("--piece-interval", type=float, default=2.0, help="seconds between workpieces per station of the stand-in")
+    parser.add_argument("--latency-budget", type=float, default=250.0, help="p95 latency in ms above which the scaling limit is reached")
+    parser.add_argument("--automation", choices=["parallel", "sequential"], default="parallel", help="server script to test")
+    parser.add_argument("--modbus-port", type=int, default=5020)
+    parser.add_argument("--opcua-port", type=int, default=4841)
+    parser.add_argument("--json", help="write the reports to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    url = f"opc.tcp://127.0.0.1:{args.opcua_port}/freeopcua/server/"
+    directory = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(directory, f"TransportInputModule_OPCUA_Server_with_{args.automation.capitalize()}_Automation.py")
+
+    stand_in = ModbusStandIn(args.modbus_port, piece_interval=args.piece_interval)
+    stand_in.start()
+
+    env = dict(os.environ, TIM_MODBUS_HOST="127.0.0.1", TIM_MODBUS_PORT=str(args.modbus_port), TIM_OPCUA_ENDPOINT=url)
+    server = subprocess.Popen([sys.executable, script], cwd=directory, env=env)
+    try:
+        reports = asyncio.run(run(args, url, ProcessCpu(server.pid)))
+        if args.json:
+            with open(args.json, 'w') as report_file:
+                json.dump(reports, report_file, indent=2)
+    finally:
+        server.terminate()
+        server.wait()
+        stand_in.stop()
+
+if __name__ == "__main__":
+
+    main()
@@ -1,18 +1,52 @@
+import os
+import asyncio
 import sys
 import time
+import queue
 import logging
 import threading
 
 from TransportInputModule_Library import *
+from TransportInputModule_Tracing import *
+from TransportInputModule_Station import *
+from TransportInputModule_Scan_Scheduler import *
+from TransportInputModule_Workpiece_Tracking import *
+from concurrent.futures import ThreadPoolExecutor
 from pyModbusTCP.client import ModbusClient
 from asyncua.sync import Server
-from asyncua import ua
+from asyncua import ua, uamethod
 
 #declare module
 
-TIM = TransportInputModule_Library("192.168.200.235")
+#Modbus node and OPC UA endpoint can be overridden through environment variables, e.g. to run against the Modbus stand-in of TransportInputModule_OPCUA_Load_Test.py
+TIM = TransportInputModule_Library(os.environ.get("TIM_MODBUS_HOST", "192.168.200.235"), port=int(os.environ.get("TIM_MODBUS_PORT", "502")))
+
+#cycle time tracing of the workpiece hand-offs
+tracer = TransportInputModule_Tracing()
+
+#scan loop with fixed period (seconds), optional SCHED_FIFO priority and CPU affinity (e.g. TIM_SCAN_CPUS="2,3")
+scheduler = TransportInputModule_Scan_Scheduler(float(os.environ.get("TIM_SCAN_PERIOD", "0.05")))
+scan_priority = int(os.environ["TIM_SCAN_PRIORITY"]) if "TIM_SCAN_PRIORITY" in os.environ else None
+scan_cpus = [int(cpu) for cpu in os.environ["TIM_SCAN_CPUS"].split(",")] if "TIM_SCAN_CPUS" in os.environ else None
+
+#OPC UA variable writes of the stations, queued by the scan loop and written by publish_station_events()
+publications = queue.SimpleQueue()
+
+def publish(name, value):
+    publications.put((name, value))
+
+#tracking of the individual workpieces on the loop, a workpiece without event for TIM_PIECE_TIMEOUT seconds is removed
+tracking = TransportInputModule_Workpiece_Tracking(conveyor_data, piece_timeout=float(os.environ.get("TIM_PIECE_TIMEOUT", "600")))
+
+stations = [TransportInputModule_Station(TIM, tracer, publish, *data, tracking=tracking) for data in conveyor_data]
+
+#own thread for the emergency stop, because asyncua runs synchronous methods one after another in a shared worker thread
+emergency_stop_executor = ThreadPoolExecutor(max_workers=1)
 
 def conveyor_move_forward(node):
+    # An emergency stop is only released by Release_Emergency_Stop, not by starting the conveyors
+    if TIM.stop_latched:
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidState)
     globals() [f"TIM_Conveyor_is_move"].write_value(True) 
     TIM.set_conveyor_speed_all(30000) 
     for conveyor_id in ['A', 'B', 'C', 'D', 'H' , 'I', 'J', 'L', 'M', 'P', 'Q', 'R', 'U', 'V']:
@@ -23,6 +57,47 @@ def conveyor_stop(node):
     for conveyor_id in ['A', 'B', 'C', 'D', 'H' , 'I', 'J', 'L', 'M', 'P', 'Q', 'R', 'U', 'V']:
         TIM.conveyor_stop(conveyor_id)
 
+def emergency_stop_all(start):
+    TIM.conveyor_stop_all()
+    latency_ms = 1000.0 * (time.perf_counter() - start)
+    globals() [f"TIM_Conveyor_is_move"].write_value(False)
+    globals() [f"TIM_Emergency_Stop_Latency_ms"].write_value(latency_ms)
+    return latency_ms
+
+def release_emergency_stop(node):
+    TIM.conveyor_release_stop()
+
+async def emergency_stop(node):
+    # Coroutine, so that the call is not queued behind the synchronous methods, the stop itself runs in emergency_stop_executor
+    start = time.perf_counter()
+    try:
+        latency_ms = await asyncio.get_running_loop().run_in_executor(emergency_stop_executor, emergency_stop_all, start)
+    except ConnectionError:
+        # The stop could not be written completely, the client has to know that the conveyors may still run
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadCommunicationError)
+    return [ua.Variant(latency_ms, ua.VariantType.Double)]
+
+@uamethod
+def execute_batch(node, actuators, actions, arguments):
+    # Entry i of the three arrays is one command (actuator, action, argument), see TransportInputModule_Library.execute_batch()
+    if not len(actuators) == len(actions) == len(arguments):
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidArgument)
+    try:
+        TIM.execute_batch(list(zip(actuators, actions, arguments)))
+    except TransportInputModule_Stop_Latched_Error:
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidState)
+    except ValueError:
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidArgument)
+
+def batch_argument(name, datatype, description):
+    argument = ua.Argument()
+    argument.Name = name
+    argument.DataType = ua.NodeId(datatype)
+    argument.ValueRank = 1
+    argument.ArrayDimensions = [0]
+    argument.Description = ua.LocalizedText(description)
+    return argument
+
 def reset_switch(node):
     print("reset switch") 
     for switch_id in ['N','T','F','W','E','G','K','S','O']:
@@ -31,24 +106,57 @@ def reset_switch(node):
 def test_server(node):
     print("Server is OK")
 
-def check_workpiece_end_of_conveyor(conveyor_name, switch_name, next_conveyor_name, switch_pre_pos, switch_post_pos):
+def export_cycle_time_trace(node):
+    tracer.export_trace("cycle_time_trace.json")
+
+def reset_workpiece_tracking(node):
+    tracking.reset()
+
+@uamethod
+def remove_workpiece(node, piece):
+    if not tracking.remove(piece):
+        raise ua.UaStatusCodeError(ua.StatusCodes.BadInvalidArgument)
 
-    while not TIM.check_conveyor_workpiece_end(conveyor_name):
-        sleep(0.05)
-    TIM.set_switch(switch_name, pos=switch_pre_pos)
-    globals()[f"workpiece_at_conveyor_{conveyor_name}"].write_value(False)
+def scan_logic(image):
+    # Step all stations in every scan cycle
+    for station in stations:
+        station.step(image)
 
-    while not TIM.check_switch_position_reached(switch_name):
-        sleep(0.05)
-    globals()[f"position_of_switch_{switch_name}"].write_value(switch_pre_pos)
+def scan_write_outputs():
+    for station in stations:
+        station.write()
 
-    while not TIM.check_switch_workpiece(switch_name):
-        sleep(0.05)
-    TIM.set_switch(switch_name, pos=switch_post_pos)
-    sleep(0.05)
-    globals()[f"position_of_switch_{switch_name}"].write_value(switch_post_pos)
-    sleep(0.05)
-    globals()[f"workpiece_at_conveyor_{next_conveyor_name}"].write_value(True)
+def publish_cycle_times():
+    for conveyor_name, switch_name in tracer.stations():
+        for phase in tracer.PHASES + [tracer.STATION]:
+            statistics = tracer.statistics(conveyor_name, switch_name, phase)
+            for key in ['last', 'mean', 'p95']:
+                globals()[f"{phase}_{key}_of_station_{conveyor_name}_{switch_name}"].write_value(statistics[key])
+            globals()[f"{phase}_histogram_of_station_{conveyor_name}_{switch_name}"].write_value(tracer.histogram(conveyor_name, switch_name, phase))
+
+    bottleneck = tracer.bottleneck()
+    if bottleneck is not None:
+        globals() [f"TIM_Bottleneck_Station"].write_value(f"{bottleneck[0]}->{bottleneck[1]}")
+        globals() [f"TIM_Bottleneck_Phase"].write_value(bottleneck[2])
+
+def publish_tracking():
+    for key, value in tracking.kpis().items():
+        globals()[f"TIM_Tracking_{key}"].write_value(value)
+    for conveyor_name, switch_name, next_conveyor_name, switch_pre_pos, switch_post_pos in conveyor_data:
+        queue_time_last, queue_time_mean = tracking.queue_time(conveyor_name)
+        globals()[f"queue_time_last_of_station_{conveyor_name}_{switch_name}"].write_value(queue_time_last)
+        globals()[f"queue_time_mean_of_station_{conveyor_name}_{switch_name}"].write_value(queue_time_mean)
+        globals()[f"workpiece_ids_at_conveyor_{conveyor_name}"].write_value(ua.Variant(tracking.pieces_on_conveyor(conveyor_name), ua.VariantType.Int64))
+
+def publish_output_statistics():
+    # The output image is read back with every publication, so that outputs changed past TIM are noticed before a write is suppressed
+    TIM.reconcile_output_image()
+    globals() [f"TIM_Suppressed_Writes"].write_value(TIM.suppressed_writes)
+    globals() [f"TIM_Reconcile_Mismatches"].write_value(TIM.reconcile_mismatches)
+
+def publish_scan_statistics():
+    for key, value in scheduler.statistics().items():
+        globals()[f"TIM_Scan_{key}"].write_value(value)
 
 def main ():
 
@@ -57,7 +165,7 @@ def main ():
 
     # setup our server
     server = Server()
-    server.set_endpoint("opc.tcp://192.168.200.191:4840/freeopcua/server/")
+    server.set_endpoint(os.environ.get("TIM_OPCUA_ENDPOINT", "opc.tcp://192.168.200.191:4840/freeopcua/server/"))
     
     # setup our own namespace, not really necessary but should as spec
     uri = "http://examples.freeopcua.github.io"
@@ -70,12 +178,50 @@ def main ():
     TIM_Server = objects.add_object(idx, "TIM_Server")
     TIM_Server_testvar = TIM_Server.add_variable(idx, "Test_Variable", 1.0)
     globals() [f"TIM_Conveyor_is_move"] = TIM_Server.add_variable(idx, "TIM_Conveyor_is_move", False , datatype=ua.NodeId(ua.ObjectIds.Boolean))
+    globals() [f"TIM_Suppressed_Writes"] = TIM_Server.add_variable(idx, "TIM_Suppressed_Writes", 0, datatype=ua.NodeId(ua.ObjectIds.Int64))
+    globals() [f"TIM_Reconcile_Mismatches"] = TIM_Server.add_variable(idx, "TIM_Reconcile_Mismatches", 0, datatype=ua.NodeId(ua.ObjectIds.Int64))
+    globals() [f"TIM_Emergency_Stop_Latency_ms"] = TIM_Server.add_variable(idx, "TIM_Emergency_Stop_Latency_ms", 0.0, datatype=ua.NodeId(ua.ObjectIds.Double))
 
     #TIM_method
     TIM_Server.add_method(ua.NodeId("Conveyor_Move_Forward", idx), ua.QualifiedName("Conveyor_Move_Forward", idx), conveyor_move_forward)
     TIM_Server.add_method(ua.NodeId("Conveyor_Stop", idx), ua.QualifiedName("Conveyor_Stop", idx), conveyor_stop)
+    TIM_Server.add_method(ua.NodeId("Emergency_Stop", idx), ua.QualifiedName("Emergency_Stop", idx), emergency_stop, [], [ua.VariantType.Double])
+    TIM_Server.add_method(ua.NodeId("Release_Emergency_Stop", idx), ua.QualifiedName("Release_Emergency_Stop", idx), release_emergency_stop)
+    TIM_Server.add_method(ua.NodeId("Execute_Batch", idx), ua.QualifiedName("Execute_Batch", idx), execute_batch, [
+        batch_argument("Actuators", ua.ObjectIds.String, "Index of the conveyor or switch per command"),
+        batch_argument("Actions", ua.ObjectIds.String, "forward, backward, stop, speed (conveyor) or switch (switch) per command"),
+        batch_argument("Arguments", ua.ObjectIds.Int64, "Speed 0 - 30000 for speed, position 0 - 3 for switch, ignored otherwise"),
+    ], [])
     TIM_Server.add_method(ua.NodeId("Reset_All_Switch", idx), ua.QualifiedName("Reset_All_Switch", idx), reset_switch)
     TIM_Server.add_method(ua.NodeId("Test_Server", idx), ua.QualifiedName("Test_Server", idx), test_server)
+    TIM_Server.add_method(ua.NodeId("Export_Cycle_Time_Trace", idx), ua.QualifiedName("Export_Cycle_Time_Trace", idx), export_cycle_time_trace)
+    TIM_Server.add_method(ua.NodeId("Reset_Workpiece_Tracking", idx), ua.QualifiedName("Reset_Workpiece_Tracking", idx), reset_workpiece_tracking)
+    TIM_Server.add_method(ua.NodeId("Remove_Workpiece", idx), ua.QualifiedName("Remove_Workpiece", idx), remove_workpiece, [ua.VariantType.Int64], [])
+
+    #Cycle time of the stations
+    globals() [f"TIM_Bottleneck_Station"] = TIM_Server.add_variable(idx, "TIM_Bottleneck_Station", "", datatype=ua.NodeId(ua.ObjectIds.String))
+    globals() [f"TIM_Bottleneck_Phase"] = TIM_Server.add_variable(idx, "TIM_Bottleneck_Phase", "", datatype=ua.NodeId(ua.ObjectIds.String))
+    for conveyor_name, switch_name, next_conveyor_name, switch_pre_pos, switch_post_pos in conveyor_data:
+        station_node = server.nodes.objects.add_object(idx, f"station_{conveyor_name}_{switch_name}")
+        for phase in tracer.PHASES + [tracer.STATION]:
+            for key in ['last', 'mean', 'p95']:
+                station_variable = station_node.add_variable(idx, f"{phase}_{key}_s", 0.0, datatype=ua.NodeId(ua.ObjectIds.Double))
+                globals()[f"{phase}_{key}_of_station_{conveyor_name}_{switch_name}"] = station_variable
+            station_variable = station_node.add_variable(idx, f"{phase}_histogram", [0] * (len(tracer.HISTOGRAM_BOUNDS) + 1), datatype=ua.NodeId(ua.ObjectIds.Int64))
+            globals()[f"{phase}_histogram_of_station_{conveyor_name}_{switch_name}"] = station_variable
+        for key in ['last', 'mean']:
+            station_variable = station_node.add_variable(idx, f"queue_time_{key}_s", 0.0, datatype=ua.NodeId(ua.ObjectIds.Double))
+            globals()[f"queue_time_{key}_of_station_{conveyor_name}_{switch_name}"] = station_variable
+
+    #Workpiece tracking KPIs
+    for key, value in tracking.kpis().items():
+        datatype = ua.ObjectIds.Int64 if isinstance(value, int) else ua.ObjectIds.Double
+        globals()[f"TIM_Tracking_{key}"] = TIM_Server.add_variable(idx, f"TIM_Tracking_{key}", value, datatype=ua.NodeId(datatype))
+
+    #Scan cycle statistics
+    for key, value in scheduler.statistics().items():
+        datatype = ua.ObjectIds.Int64 if isinstance(value, int) else ua.ObjectIds.Double
+        globals()[f"TIM_Scan_{key}"] = TIM_Server.add_variable(idx, f"TIM_Scan_{key}", value, datatype=ua.NodeId(datatype))
 
     #Switch
     switch_names = ['E', 'F', 'G', 'K', 'N', 'O', 'S', 'T', 'W']
@@ -90,37 +236,44 @@ def main ():
         conveyor_node = server.nodes.objects.add_object(idx, f"conveyor_{amounth_of_conveyer}")
         conveyor_variable = conveyor_node.add_variable(idx, f"workpiece_at_conveyor_{amounth_of_conveyer}", False, datatype=ua.NodeId(ua.ObjectIds.Boolean))
         globals()[f"workpiece_at_conveyor_{amounth_of_conveyer}"] = conveyor_variable
+        conveyor_variable = conveyor_node.add_variable(idx, f"workpiece_ids_at_conveyor_{amounth_of_conveyer}", ua.Variant([], ua.VariantType.Int64), datatype=ua.NodeId(ua.ObjectIds.Int64))
+        globals()[f"workpiece_ids_at_conveyor_{amounth_of_conveyer}"] = conveyor_variable
 
     #Server start
     server.start()
-    while True:
-        sleep(0.5)
-        new_val = TIM_Server_testvar.get_value() + 0.1
-        _logger.info("Set value of %s to %.1f", TIM_Server_testvar, new_val)
-        TIM_Server_testvar.write_value(new_val)
-
-        # Run check_workpiece_end_of_conveyor in separate threads
-        conveyor_data = [
-            ("L", "N", "Q", 3, 1),
-            ("Q", "T", "H", 3, 1),
-            ("H", "F", "D", 3, 1),
-            ("D", "W", "A", 3, 2),
-            ("A", "E", "B", 3, 2),
-            ("B", "G", "I", 3, 1),
-            ("I", "K", "R", 1, 3),
-            ("R", "S", "P", 2, 1),
-            ("P", "O", "L", 1, 3)
-        ]
-        threads = []
-
-        for data in conveyor_data:
-            thread = threading.Thread(target=check_workpiece_end_of_conveyor, args=data)
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-   
+
+    # Heartbeat and statistics are published by a separate thread, so that the OPC UA writes do not load the scan cycle
+    def publish_statistics():
+        while True:
+            sleep(0.5)
+            # A failed publication is logged and the thread goes on, otherwise statistics and reconciliation would stop silently
+            try:
+                new_val = TIM_Server_testvar.get_value() + 0.1
+                _logger.info("Set value of %s to %.1f", TIM_Server_testvar, new_val)
+                TIM_Server_testvar.write_value(new_val)
+                publish_cycle_times()
+                publish_tracking()
+                publish_output_statistics()
+                publish_scan_statistics()
+            except Exception:
+                _logger.exception("Publishing the statistics failed")
+
+    threading.Thread(target=publish_statistics, daemon=True).start()
+
+    # The variable writes of the stations are drained from the queue by their own thread, the scan loop never waits for OPC UA
+    def publish_station_events():
+        while True:
+            name, value = publications.get()
+            try:
+                globals()[name].write_value(value)
+            except Exception:
+                _logger.exception("Publishing %s = %r failed", name, value)
+
+    threading.Thread(target=publish_station_events, daemon=True).start()
+
+    scheduler.set_realtime(scan_priority, scan_cpus)
+    scheduler.run(TIM.get_input_image, scan_logic, scan_write_outputs)
+
 if __name__ == "__main__":
 
     main()
\ No newline at end of file
@@ -0,0 +1,146 @@
+import os
+import logging
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+
+
+_logger = logging.getLogger(__name__)
+
+
+class TransportInputModule_Scan_Scheduler:
+    #Fixed-period scan loop like in a PLC: every cycle reads the inputs, runs the logic and writes the outputs.
+    #The cycles are started at absolute monotonic deadlines (start + n * period) instead of sleeping a relative time
+    #after the work, so the period does not drift with the duration of the work.
+
+    def __init__(self, period = 0.05, window = 1000):
+        #"""
+        #constructor of the scan scheduler.
+
+        #:param period Cycle period in seconds
+        #:param window Number of the latest cycles which are kept for the jitter percentile
+        #"""
+        self.period = period
+
+        #lock, because the statistics are read from the OPC UA server thread
+        self.lock = threading.Lock()
+
+        self.cycles = 0
+        #Cycles which did not finish before the deadline of the next cycle
+        self.overruns = 0
+        #Cycles which were skipped, because an overrun took longer than one period
+        self.skipped_cycles = 0
+        #Cycles which were aborted by an exception
+        self.errors = 0
+
+        #Jitter: delay of the start of a cycle after its deadline in seconds
+        self.jitter = deque(maxlen=window)
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+
+        #Duration of the phases of the last cycle and longest cycle in seconds
+        self.read_time = 0.0
+        self.logic_time = 0.0
+        self.write_time = 0.0
+        self.execution_max = 0.0
+
+    def set_realtime(self, priority = None, cpus = None):
+        #"""
+        #Raises the scheduling priority and/or pins the calling thread to CPUs (Linux only).
+        #Must be called from the thread which runs the scan loop. Failures (e.g. missing rights) are logged and ignored.
+
+        #:param priority SCHED_FIFO priority between 1 and 99 (None = keep the default scheduling)
+        #:param cpus List of CPU numbers to which the thread is pinned (None = all CPUs)
+        #"""
+        if priority is not None:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            except (AttributeError, OSError) as error:
+                _logger.warning("Cannot set SCHED_FIFO priority %s: %s", priority, error)
+        if cpus is not None:
+            try:
+                os.sched_setaffinity(0, cpus)
+            except (AttributeError, OSError) as error:
+                _logger.warning("Cannot set CPU affinity %s: %s", cpus, error)
+
+    def run(self, read_inputs, logic, write_outputs, stop_event = None):
+        #"""
+        #Runs the scan loop until stop_event is set (or forever if there is no stop_event).
+
+        #:param read_inputs Function without parameters which reads and returns the input image
+        #:param logic Function which gets the input image and decides which outputs have to be written
+        #:param write_outputs Function without parameters which writes the outputs decided by logic
+        #:param stop_event threading.Event to stop the loop
+        #"""
+        deadline = monotonic()
+        while stop_event is None or not stop_event.is_set():
+            now = monotonic()
+            if deadline > now:
+                sleep(deadline - now)
+
+            start = monotonic()
+            after_read = after_logic = start
+            error = False
+            try:
+                image = read_inputs()
+                after_read = monotonic()
+                logic(image)
+                after_logic = monotonic()
+                write_outputs()
+            except Exception:
+                #A failing cycle is counted and logged, the loop goes on with the next cycle at its deadline
+                _logger.exception("Scan cycle %d failed", self.cycles + 1)
+                error = True
+            end = monotonic()
+
+            jitter = start - deadline
+            deadline += self.period
+            overrun = end > deadline
+            skipped = 0
+            if overrun:
+                #Missed cycles are skipped instead of caught up, so that no burst of cycles runs after an overrun
+                skipped = int((end - deadline) / self.period)
+                deadline += skipped * self.period
+
+            with self.lock:
+                self.cycles += 1
+                self.overruns += overrun
+                self.skipped_cycles += skipped
+                self.errors += error
+                if len(self.jitter) == self.jitter.maxlen:
+                    self.jitter_sum -= self.jitter[0]
+                self.jitter.append(jitter)
+                self.jitter_sum += jitter
+                self.jitter_max = max(self.jitter_max, jitter)
+                self.read_time = after_read - start
+                self.logic_time = after_logic - after_read
+                self.write_time = end - after_logic
+                self.execution_max = max(self.execution_max, end - start)
+
+    def statistics(self):
+        #"""
+        #Returns the cycle statistics, times in milliseconds.
+
+        #:returns dict with period, cycles, overruns, skipped cycles, errors, jitter (last, mean, p99, max) and execution times
+        #:rtype dict
+        #"""
+        with self.lock:
+            jitter = list(self.jitter)
+            statistics = {
+                'period_ms' : 1000.0 * self.period,
+                'cycles' : self.cycles,
+                'overruns' : self.overruns,
+                'skipped_cycles' : self.skipped_cycles,
+                'errors' : self.errors,
+                'jitter_last_ms' : 1000.0 * jitter[-1] if jitter else 0.0,
+                'jitter_mean_ms' : 1000.0 * self.jitter_sum / len(jitter) if jitter else 0.0,
+                'jitter_max_ms' : 1000.0 * self.jitter_max,
+                'read_ms' : 1000.0 * self.read_time,
+                'logic_ms' : 1000.0 * self.logic_time,
+                'write_ms' : 1000.0 * self.write_time,
+                'execution_max_ms' : 1000.0 * self.execution_max,
+            }
+        ordered = sorted(jitter)
+        statistics['jitter_p99_ms'] = 1000.0 * ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] if ordered else 0.0
+        return statistics
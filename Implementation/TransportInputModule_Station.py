@@ -0,0 +1,126 @@
+from time import perf_counter
+
+
+
+#Stations of the loop, shared by the OPC UA servers and the load test:
+#(conveyor, switch, next conveyor, switch position towards the conveyor, switch position towards the next conveyor)
+conveyor_data = [
+    ("L", "N", "Q", 3, 1),
+    ("Q", "T", "H", 3, 1),
+    ("H", "F", "D", 3, 1),
+    ("D", "W", "A", 3, 2),
+    ("A", "E", "B", 3, 2),
+    ("B", "G", "I", 3, 1),
+    ("I", "K", "R", 1, 3),
+    ("R", "S", "P", 2, 1),
+    ("P", "O", "L", 1, 3)
+]
+
+
+class TransportInputModule_Station:
+    #Hand-off of workpieces from the end of a conveyor through a switch onto the next conveyor as non-blocking state machine.
+    #step() is called with the input image of every scan cycle and only decides, write() executes the decided outputs,
+    #so one station never blocks the scan loop while it waits for a sensor.
+
+    #States of the station, named like the phases of TransportInputModule_Tracing
+    WAIT_CONVEYOR_END = 'wait_conveyor_end'
+    WAIT_SWITCH_POSITION = 'wait_switch_position'
+    WAIT_SWITCH_WORKPIECE = 'wait_switch_workpiece'
+
+    def __init__(self, TIM, tracer, publish, conveyor_name, switch_name, next_conveyor_name, switch_pre_pos, switch_post_pos, tracking = None):
+        #"""
+        #constructor of the station.
+
+        #:param TIM TransportInputModule_Library which controls the switch
+        #:param tracer TransportInputModule_Tracing which records the phases of the hand-offs
+        #:param publish Function (variable name, value) which hands the value of an OPC UA variable on for writing, must not block the scan loop
+        #:param conveyor_name Index of the conveyor at which the workpiece arrives
+        #:param switch_name Index of the switch which passes the workpiece on
+        #:param next_conveyor_name Index of the conveyor which gets the workpiece
+        #:param switch_pre_pos Position of the switch towards conveyor_name
+        #:param switch_post_pos Position of the switch towards next_conveyor_name
+        #:param tracking TransportInputModule_Workpiece_Tracking which gets the arrivals and hand-offs (None = no tracking)
+        #"""
+        self.TIM = TIM
+        self.tracer = tracer
+        self.publish = publish
+        self.conveyor_name = conveyor_name
+        self.switch_name = switch_name
+        self.next_conveyor_name = next_conveyor_name
+        self.switch_pre_pos = switch_pre_pos
+        self.switch_post_pos = switch_post_pos
+        self.tracking = tracking
+
+        self.state = self.WAIT_CONVEYOR_END
+        self.station_begin = perf_counter()
+        self.phase_begin = self.station_begin
+
+        #Outputs decided by step() and written by write()
+        self.switch_command = None
+        self.publications = []
+        self.write_phase = None
+
+    def step(self, image):
+        #"""
+        #Advances the state machine with the input image of the current scan cycle.
+
+        #:param image input image from TransportInputModule_Library.get_input_image()
+        #:returns True if the workpiece was handed off to the next conveyor in this step
+        #:rtype bool
+        #"""
+        if self.state == self.WAIT_CONVEYOR_END:
+            if self.TIM.check_conveyor_workpiece_end(self.conveyor_name, image):
+                self._leave_phase()
+                if self.tracking is not None:
+                    self.tracking.arrive(self.conveyor_name)
+                self.switch_command = self.switch_pre_pos
+                self.publications.append((f"workpiece_at_conveyor_{self.conveyor_name}", False))
+                self.write_phase = 'set_switch_pre'
+                self.state = self.WAIT_SWITCH_POSITION
+
+        elif self.state == self.WAIT_SWITCH_POSITION:
+            if self.TIM.check_switch_position_reached(self.switch_name, image):
+                self._leave_phase()
+                self.publications.append((f"position_of_switch_{self.switch_name}", self.switch_pre_pos))
+                self.state = self.WAIT_SWITCH_WORKPIECE
+
+        elif self.state == self.WAIT_SWITCH_WORKPIECE:
+            if self.TIM.check_switch_workpiece(self.switch_name, image):
+                self._leave_phase()
+                if self.tracking is not None:
+                    self.tracking.hand_off(self.conveyor_name, self.next_conveyor_name)
+                self.switch_command = self.switch_post_pos
+                self.publications.append((f"position_of_switch_{self.switch_name}", self.switch_post_pos))
+                self.publications.append((f"workpiece_at_conveyor_{self.next_conveyor_name}", True))
+                self.write_phase = 'handover'
+                self.state = self.WAIT_CONVEYOR_END
+                return True
+
+        return False
+
+    def write(self):
+        #"""
+        #Writes the outputs decided by the last step() to the switch and passes the OPC UA variables to publish.
+        #"""
+        begin = perf_counter()
+        if self.switch_command is not None:
+            self.TIM.set_switch(self.switch_name, pos=self.switch_command)
+        for name, value in self.publications:
+            self.publish(name, value)
+        end = perf_counter()
+
+        if self.write_phase is not None:
+            self.tracer.record(self.conveyor_name, self.switch_name, self.write_phase, begin, end)
+            self.phase_begin = end
+            if self.write_phase == 'handover':
+                self.tracer.record(self.conveyor_name, self.switch_name, self.tracer.STATION, self.station_begin, end)
+                self.station_begin = end
+
+        self.switch_command = None
+        self.publications = []
+        self.write_phase = None
+
+    def _leave_phase(self):
+        now = perf_counter()
+        self.tracer.record(self.conveyor_name, self.switch_name, self.state, self.phase_begin, now)
+        self.phase_begin = now
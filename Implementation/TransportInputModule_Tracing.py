@@ -0,0 +1,154 @@
+import json
+import threading
+from collections import deque
+from time import perf_counter
+
+
+
+class TransportInputModule_Tracing:
+    #Konstanten
+    #Phases of a workpiece hand-off from a conveyor through a switch onto the next conveyor (see check_workpiece_end_of_conveyor)
+    PHASES = ['wait_conveyor_end', 'set_switch_pre', 'wait_switch_position', 'wait_switch_workpiece', 'handover']
+    #Phase in which the station waits for the next workpiece (starved, not busy)
+    IDLE_PHASE = 'wait_conveyor_end'
+    #Span which covers one complete hand-off of a station
+    STATION = 'station'
+    #Upper bounds of the histogram buckets in seconds, the last bucket collects everything above the last bound
+    HISTOGRAM_BOUNDS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+    def __init__(self, window = 100, max_events = 20000):
+        #"""
+        #constructor of the cycle time tracer.
+
+        #:param window Number of the latest spans per (conveyor, switch) pair and phase which are kept for the rolling statistics
+        #:param max_events Number of the latest spans which are kept for the trace file
+        #"""
+        self.window = window
+
+        #lock, because the stations of the parallel automation are traced from several threads
+        self.lock = threading.Lock()
+
+        #(conveyor, switch) -> phase -> durations of the latest spans in seconds
+        self.samples = {}
+
+        #latest spans as events of the Trace Event Format (chrome://tracing, Perfetto)
+        self.events = deque(maxlen=max_events)
+
+        self.start_time = perf_counter()
+
+    def record(self, conveyor_id, switch_id, phase, begin, end):
+        #"""
+        #Adds a finished span to the rolling statistics and to the trace.
+
+        #:param conveyor_id Index of the conveyor of the station as character
+        #:param switch_id Index of the switch of the station as character
+        #:param phase Name of the phase
+        #:param begin Start of the span as perf_counter() value
+        #:param end End of the span as perf_counter() value
+        #"""
+        duration = end - begin
+        event = {
+            'name' : phase,
+            'cat' : f"{conveyor_id}->{switch_id}",
+            'ph' : 'X',
+            'ts' : (begin - self.start_time) * 1e6,
+            'dur' : duration * 1e6,
+            'pid' : 1,
+            'tid' : f"station_{conveyor_id}_{switch_id}",
+        }
+        with self.lock:
+            phases = self.samples.setdefault((conveyor_id, switch_id), {})
+            if phase not in phases:
+                phases[phase] = deque(maxlen=self.window)
+            phases[phase].append(duration)
+            self.events.append(event)
+
+    def stations(self):
+        #"""
+        #Returns all (conveyor, switch) pairs for which spans were recorded.
+
+        #:returns list of (conveyor_id, switch_id)
+        #:rtype list of tuple
+        #"""
+        with self.lock:
+            return list(self.samples.keys())
+
+    def histogram(self, conveyor_id, switch_id, phase):
+        #"""
+        #Returns the rolling histogram of a phase of the station (conveyor_id, switch_id).
+
+        #:param conveyor_id Index of the conveyor of the station as character
+        #:param switch_id Index of the switch of the station as character
+        #:param phase Name of the phase
+        #:returns Number of spans per bucket of HISTOGRAM_BOUNDS (plus one bucket for longer spans)
+        #:rtype list of int
+        #"""
+        counts = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+        for duration in self._durations(conveyor_id, switch_id, phase):
+            bucket = 0
+            while bucket < len(self.HISTOGRAM_BOUNDS) and duration > self.HISTOGRAM_BOUNDS[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+        return counts
+
+    def statistics(self, conveyor_id, switch_id, phase):
+        #"""
+        #Returns the rolling statistics of a phase of the station (conveyor_id, switch_id).
+
+        #:param conveyor_id Index of the conveyor of the station as character
+        #:param switch_id Index of the switch of the station as character
+        #:param phase Name of the phase
+        #:returns dict with count, last, mean, p95 and max of the durations in seconds (0.0 if there is no span yet)
+        #:rtype dict
+        #"""
+        durations = self._durations(conveyor_id, switch_id, phase)
+        if not durations:
+            return {'count' : 0, 'last' : 0.0, 'mean' : 0.0, 'p95' : 0.0, 'max' : 0.0}
+
+        ordered = sorted(durations)
+        return {
+            'count' : len(durations),
+            'last' : durations[-1],
+            'mean' : sum(durations) / len(durations),
+            'p95' : ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+            'max' : ordered[-1],
+        }
+
+    def bottleneck(self):
+        #"""
+        #Determines the station with the longest mean busy time (hand-off without waiting for the next workpiece, see IDLE_PHASE)
+        #and the phase which takes the longest within this station. A station which is only starved is no bottleneck.
+
+        #:returns (conveyor_id, switch_id, phase) or None if there is no complete hand-off yet
+        #:rtype tuple or none
+        #"""
+        slowest = None
+        slowest_busy = None
+        for conveyor_id, switch_id in self.stations():
+            if not self._durations(conveyor_id, switch_id, self.STATION):
+                continue
+            busy = self.statistics(conveyor_id, switch_id, self.STATION)['mean'] - self.statistics(conveyor_id, switch_id, self.IDLE_PHASE)['mean']
+            if slowest_busy is None or busy > slowest_busy:
+                slowest = (conveyor_id, switch_id)
+                slowest_busy = busy
+        if slowest is None:
+            return None
+
+        busy_phases = [p for p in self.PHASES if p != self.IDLE_PHASE]
+        phase = max(busy_phases, key=lambda p: self.statistics(slowest[0], slowest[1], p)['mean'])
+        return (slowest[0], slowest[1], phase)
+
+    def export_trace(self, path):
+        #"""
+        #Writes the recorded spans as trace file in the Trace Event Format, which can be opened with chrome://tracing or Perfetto.
+
+        #:param path Path of the trace file
+        #"""
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, trace_file)
+
+    def _durations(self, conveyor_id, switch_id, phase):
+        with self.lock:
+            return list(self.samples.get((conveyor_id, switch_id), {}).get(phase, ()))
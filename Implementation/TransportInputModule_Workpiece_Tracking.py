@@ -0,0 +1,226 @@
+import threading
+from array import array
+from collections import deque
+from time import monotonic
+
+
+
+class TransportInputModule_Workpiece_Tracking:
+    #Tracks the individual workpieces on the loop of conveyor_data: every workpiece gets an ID when it is detected for the
+    #first time and is moved from conveyor to conveyor on the sensor edges reported by TransportInputModule_Station.
+    #The state of the workpieces is kept in arrays indexed by the ID and the KPIs are updated with every event,
+    #so reading them never has to go through the history.
+
+    #Position of a workpiece which was handed off to a conveyor outside of the loop
+    LEFT_LOOP = -1
+    #Position of a workpiece which was removed from the tracking (remove(), reset() or piece_timeout)
+    REMOVED = -2
+
+    def __init__(self, conveyor_data, window = 60.0, piece_timeout = None, now = None):
+        #"""
+        #constructor of the workpiece tracking.
+
+        #:param conveyor_data List of stations (conveyor, switch, next conveyor, switch pre position, switch post position)
+        #:param window Time window in seconds over which the throughput is determined
+        #:param piece_timeout Seconds without arrival or hand-off after which a workpiece is removed, e.g. because it was taken
+        #off the loop by hand (None = workpieces are only removed by remove() and reset())
+        #:param now Start of the tracking (monotonic)
+        #"""
+        self.window = window
+        self.piece_timeout = piece_timeout
+
+        #lock, because the events come from the scan loop and the KPIs are read by the OPC UA publisher
+        self.lock = threading.Lock()
+
+        self.conveyors = [data[0] for data in conveyor_data]
+        self.conveyor_nr = {conveyor_id : nr for nr, conveyor_id in enumerate(self.conveyors)}
+
+        #Workpieces, indexed by ID: position (index of the conveyor, LEFT_LOOP or REMOVED), conveyor of the start of the lap,
+        #time of the start of the lap, time of the arrival at the end of the current conveyor, time of the last event and number of completed laps
+        self.position = array('b')
+        self.lap_origin = array('b')
+        self.lap_start = array('d')
+        self.arrival = array('d')
+        self.last_event = array('d')
+        self.laps = array('l')
+
+        #IDs of the workpieces on each conveyor in order of their arrival (first = next at the conveyor end)
+        self.queues = [deque() for _ in self.conveyors]
+        self.wip = 0
+
+        self._reset_kpis(monotonic() if now is None else now)
+
+    def arrive(self, conveyor_id, now = None):
+        #"""
+        #Workpiece arrived at the end of the conveyor (rising edge of the sensor at the end of the conveyor).
+        #If there is no tracked workpiece on the conveyor, a new workpiece enters the loop here.
+
+        #:param conveyor_id Index of the conveyor as character
+        #:param now Time of the event (monotonic)
+        #:returns ID of the workpiece
+        #:rtype int
+        #"""
+        now = monotonic() if now is None else now
+        nr = self.conveyor_nr[conveyor_id]
+        with self.lock:
+            queue = self.queues[nr]
+            if not queue:
+                piece = len(self.position)
+                self.position.append(nr)
+                self.lap_origin.append(nr)
+                self.lap_start.append(now)
+                self.arrival.append(now)
+                self.last_event.append(now)
+                self.laps.append(0)
+                queue.append(piece)
+                self.wip += 1
+                return piece
+
+            piece = queue[0]
+            self.arrival[piece] = now
+            self.last_event[piece] = now
+            if nr == self.lap_origin[piece]:
+                lead_time = now - self.lap_start[piece]
+                self.lead_time_last = lead_time
+                self.lead_time_sum += lead_time
+                self.lead_time_count += 1
+                self.lap_start[piece] = now
+                self.laps[piece] += 1
+            return piece
+
+    def hand_off(self, conveyor_id, next_conveyor_id, now = None):
+        #"""
+        #Workpiece at the end of the conveyor went through the switch and is handed off to the next conveyor
+        #(workpiece detected in the switch, switch is set towards the next conveyor).
+
+        #:param conveyor_id Index of the conveyor as character
+        #:param next_conveyor_id Index of the next conveyor as character
+        #:param now Time of the event (monotonic)
+        #:returns ID of the workpiece or None if no workpiece is tracked on the conveyor
+        #:rtype int or none
+        #"""
+        now = monotonic() if now is None else now
+        nr = self.conveyor_nr[conveyor_id]
+        with self.lock:
+            if not self.queues[nr]:
+                return None
+            piece = self.queues[nr].popleft()
+            self.last_event[piece] = now
+
+            queue_time = now - self.arrival[piece]
+            self.queue_time_last[nr] = queue_time
+            self.queue_time_sum[nr] += queue_time
+            self.queue_time_count[nr] += 1
+
+            next_nr = self.conveyor_nr.get(next_conveyor_id, self.LEFT_LOOP)
+            self.position[piece] = next_nr
+            if next_nr == self.LEFT_LOOP:
+                #next conveyor is not part of the loop, the workpiece leaves the tracking
+                self.wip -= 1
+            else:
+                self.queues[next_nr].append(piece)
+
+            self.handoffs.append(now)
+            self._expire(now)
+            return piece
+
+    def remove(self, piece):
+        #"""
+        #Removes a workpiece from the tracking, e.g. because it was taken off the loop by hand.
+
+        #:param piece ID of the workpiece
+        #:returns True if the workpiece was on the loop
+        #:rtype bool
+        #"""
+        with self.lock:
+            if not 0 <= piece < len(self.position) or self.position[piece] < 0:
+                return False
+            self._remove(piece)
+            return True
+
+    def reset(self, now = None):
+        #"""
+        #Removes all workpieces from the tracking and restarts the KPIs. The IDs of new workpieces continue after the removed ones.
+
+        #:param now Time of the restart (monotonic)
+        #"""
+        now = monotonic() if now is None else now
+        with self.lock:
+            for queue in self.queues:
+                while queue:
+                    self._remove(queue[0])
+            self._reset_kpis(now)
+
+    def kpis(self, now = None):
+        #"""
+        #Returns the KPIs of the loop.
+
+        #:param now Time at which the throughput is evaluated (monotonic)
+        #:returns dict with pieces per minute (average hand-offs per station), WIP, laps and lead time per lap (last and mean in seconds)
+        #:rtype dict
+        #"""
+        now = monotonic() if now is None else now
+        with self.lock:
+            self._expire(now)
+            self._expire_pieces(now)
+            #the throughput of the first window is related to the time since the start, not to the whole window
+            span = min(self.window, now - self.start_time)
+            return {
+                'pieces_per_minute' : len(self.handoffs) * 60.0 / span / len(self.conveyors) if span > 0 else 0.0,
+                'wip' : self.wip,
+                'laps' : self.lead_time_count,
+                'lead_time_last_s' : self.lead_time_last,
+                'lead_time_mean_s' : self.lead_time_sum / self.lead_time_count if self.lead_time_count else 0.0,
+            }
+
+    def queue_time(self, conveyor_id):
+        #"""
+        #Returns the queue time of the station of the conveyor.
+
+        #:param conveyor_id Index of the conveyor of the station as character
+        #:returns (last, mean) queue time in seconds
+        #:rtype tuple
+        #"""
+        nr = self.conveyor_nr[conveyor_id]
+        with self.lock:
+            count = self.queue_time_count[nr]
+            return (self.queue_time_last[nr], self.queue_time_sum[nr] / count if count else 0.0)
+
+    def pieces_on_conveyor(self, conveyor_id):
+        #"""
+        #Returns the IDs of the workpieces on the conveyor, the first one is the next at the conveyor end.
+
+        #:param conveyor_id Index of the conveyor as character
+        #:rtype list of int
+        #"""
+        with self.lock:
+            return list(self.queues[self.conveyor_nr[conveyor_id]])
+
+    def _expire(self, now):
+        while self.handoffs and self.handoffs[0] < now - self.window:
+            self.handoffs.popleft()
+
+    def _expire_pieces(self, now):
+        if self.piece_timeout is None:
+            return
+        for queue in self.queues:
+            for piece in [piece for piece in queue if self.last_event[piece] < now - self.piece_timeout]:
+                self._remove(piece)
+
+    def _remove(self, piece):
+        self.queues[self.position[piece]].remove(piece)
+        self.position[piece] = self.REMOVED
+        self.wip -= 1
+
+    def _reset_kpis(self, now):
+        #KPIs, the throughput is counted from start_time
+        self.start_time = now
+        self.handoffs = deque()
+        self.lead_time_last = 0.0
+        self.lead_time_sum = 0.0
+        self.lead_time_count = 0
+
+        #Station (index of its conveyor), queue time = time from the arrival at the conveyor end to the hand-off
+        self.queue_time_last = array('d', [0.0] * len(self.conveyors))
+        self.queue_time_sum = array('d', [0.0] * len(self.conveyors))
+        self.queue_time_count = array('l', [0] * len(self.conveyors))
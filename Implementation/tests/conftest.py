@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules of the Implementation folder are imported by their file name, like the OPC UA servers do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,267 @@
+import pytest
+
+pytest.importorskip("pyModbusTCP")
+
+from TransportInputModule_Library import TransportInputModule_Library, TransportInputModule_Stop_Latched_Error
+
+
+class FakeModbusNode:
+    #holding registers of a Modbus node in memory, used in place of the ModbusClient of the library
+    def __init__(self):
+        self.registers = {}
+        self.requests = []
+        #number of the next requests which fail
+        self.failures = 0
+        #function which is called after every read (e.g. to interleave another command)
+        self.after_read = None
+
+    def open(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _fail(self):
+        if self.failures:
+            self.failures -= 1
+            return True
+        return False
+
+    def read_holding_registers(self, reg_addr, reg_nb = 1):
+        self.requests.append(('read', reg_addr, reg_nb))
+        if self._fail():
+            return None
+        result = [self.registers.get(reg_addr + i, 0) for i in range(reg_nb)]
+        if self.after_read is not None:
+            after_read, self.after_read = self.after_read, None
+            after_read()
+        return result
+
+    def write_multiple_registers(self, regs_addr, regs_value):
+        self.requests.append(('write', regs_addr, list(regs_value)))
+        if self._fail():
+            return False
+        for i, value in enumerate(regs_value):
+            self.registers[regs_addr + i] = value
+        return True
+
+    def write_single_register(self, reg_addr, reg_value):
+        return self.write_multiple_registers(reg_addr, [reg_value])
+
+    def writes(self):
+        return [request for request in self.requests if request[0] == 'write']
+
+
+@pytest.fixture
+def node():
+    return FakeModbusNode()
+
+
+@pytest.fixture
+def TIM(node):
+    TIM = TransportInputModule_Library("127.0.0.1")
+    TIM.client = node
+    TIM.stop_client = node
+    return TIM
+
+
+def output_bit(TIM, node, index, nr):
+    offset = TIM.get_offset(TIM.INDEX.get(index)[nr])
+    return bool(node.registers.get(TIM.DIGITAL_OUTPUT_STARTING_ADDRESS + offset, 0) >> TIM.get_bit(index, nr) & 1)
+
+
+def test_stop_all_clears_conveyors_and_keeps_switches(TIM, node):
+    TIM.conveyor_forward('A')
+    TIM.set_switch('E', pos=3)
+
+    TIM.conveyor_stop_all()
+
+    assert not output_bit(TIM, node, 'A', 0)
+    assert output_bit(TIM, node, 'E', 3)
+    assert TIM.conveyor_speed['A'] == 0
+
+
+def test_stop_all_keeps_switch_command_during_stop(TIM, node):
+    TIM.conveyor_forward('A')
+    TIM.set_switch('E', pos=3)
+    #switch command which is written between the read and the write of the stop
+    node.after_read = lambda: TIM.set_switch('E', pos=1)
+
+    TIM.conveyor_stop_all()
+
+    assert not output_bit(TIM, node, 'A', 0)
+    assert output_bit(TIM, node, 'E', 1)
+    assert not output_bit(TIM, node, 'E', 3)
+
+
+def test_stop_all_retries_failed_requests(TIM, node):
+    TIM.conveyor_forward('A')
+    node.failures = TIM.STOP_ATTEMPTS - 1
+
+    TIM.conveyor_stop_all()
+
+    assert not output_bit(TIM, node, 'A', 0)
+
+
+def test_stop_all_reports_failure(TIM, node):
+    TIM.conveyor_forward('A')
+    node.failures = 1000
+
+    with pytest.raises(ConnectionError):
+        TIM.conveyor_stop_all()
+    assert TIM.stop_latched
+    assert not TIM.conveyor_speed_written
+
+
+def test_batch_writes_speed_before_direction(TIM, node):
+    TIM.execute_batch([('A', 'forward', 0), ('A', 'speed', 30000)])
+
+    direction_write = next(i for i, request in enumerate(node.requests) if request[0] == 'write' and request[1] == TIM.DIGITAL_OUTPUT_STARTING_ADDRESS + 1)
+    speed_writes = [i for i, request in enumerate(node.requests) if request[0] == 'write' and request[1] == 8025]
+    assert speed_writes and max(speed_writes) < direction_write
+    assert output_bit(TIM, node, 'A', 0)
+
+
+def test_batch_rejects_start_during_emergency_stop(TIM, node):
+    TIM.conveyor_stop_all()
+    writes = len(node.writes())
+
+    with pytest.raises(TransportInputModule_Stop_Latched_Error):
+        TIM.execute_batch([('E', 'switch', 2), ('A', 'forward', 0)])
+    assert len(node.writes()) == writes
+
+    #stopping and switching are still allowed
+    TIM.execute_batch([('E', 'switch', 2), ('A', 'stop', 0)])
+    assert output_bit(TIM, node, 'E', 2)
+
+
+@pytest.mark.parametrize("command", [
+    ('A', 'speed', 30001),
+    ('A', 'speed', "100"),
+    ('A', 'speed', 1.5),
+    ('A', 'jump', 0),
+    ('E', 'switch', 4),
+    ('E', 'switch', True),
+    ('E', 'forward', 0),
+    ('Z', 'stop', 0),
+])
+def test_batch_rejects_invalid_command(TIM, node, command):
+    with pytest.raises(ValueError):
+        TIM.execute_batch([command])
+    assert node.writes() == []
+
+
+def set_node_bit(TIM, node, index, nr, value):
+    address = TIM.DIGITAL_OUTPUT_STARTING_ADDRESS + TIM.get_offset(TIM.INDEX.get(index)[nr])
+    bit = 1 << TIM.get_bit(index, nr)
+    node.registers[address] = node.registers.get(address, 0) | bit if value else node.registers.get(address, 0) & ~bit
+
+
+def test_unchanged_command_is_suppressed(TIM, node):
+    TIM.conveyor_forward('A')
+    writes = len(node.writes())
+
+    TIM.conveyor_forward('A')
+
+    assert len(node.writes()) == writes
+    assert TIM.suppressed_writes == 1
+
+
+def test_write_keeps_bits_changed_past_the_image(TIM, node):
+    TIM.conveyor_forward('A')
+    #A is stopped and C started past the library (e.g. by a second instance on the same node)
+    set_node_bit(TIM, node, 'A', 0, False)
+    set_node_bit(TIM, node, 'C', 0, True)
+
+    TIM.execute_batch([('D', 'forward', 0)])
+
+    assert not output_bit(TIM, node, 'A', 0)
+    assert output_bit(TIM, node, 'C', 0)
+    assert output_bit(TIM, node, 'D', 0)
+    assert TIM.reconcile_mismatches == 1
+
+
+def test_reconcile_ends_suppression_against_outdated_image(TIM, node):
+    TIM.conveyor_forward('A')
+    set_node_bit(TIM, node, 'A', 0, False)
+
+    TIM.reconcile_output_image()
+    TIM.conveyor_forward('A')
+
+    assert TIM.reconcile_mismatches == 1
+    assert TIM.suppressed_writes == 0
+    assert output_bit(TIM, node, 'A', 0)
+
+
+def test_repeated_homing_is_written(TIM, node):
+    TIM.set_switch('E', pos=0)
+    writes = len(node.writes())
+
+    TIM.set_switch('E', pos=0)
+
+    #the homing bit is cleared and set again
+    assert [request[2] for request in node.writes()[writes:]] == [[0], [1 << TIM.get_bit('E', 0)]]
+    assert output_bit(TIM, node, 'E', 0)
+
+
+def test_read_back_during_stop_is_discarded(TIM, node):
+    TIM.conveyor_forward('A')
+    #the stop changes the outputs after the read back read them
+    node.after_read = TIM.conveyor_stop_all
+
+    TIM.reconcile_output_image()
+    TIM.conveyor_release_stop()
+    TIM.conveyor_forward('A')
+
+    assert TIM.suppressed_writes == 0
+    assert output_bit(TIM, node, 'A', 0)
+
+
+def test_speed_update_during_stop_is_not_trusted(TIM, node):
+    TIM.set_conveyor_speed_all(30000)
+    #the stop zeroes the speeds while update_conveyor_speed() writes the control registers
+    writes = node.write_multiple_registers
+    def write_with_stop(regs_addr, regs_value):
+        if regs_addr == 8024 and TIM.speed_stops_started == 0:
+            TIM.conveyor_stop_all()
+        return writes(regs_addr, regs_value)
+    node.write_multiple_registers = write_with_stop
+    TIM.set_conveyor_speed_all(20000)
+    node.write_multiple_registers = writes
+    assert not TIM.conveyor_speed_written
+
+    #so setting the speed to 0 afterwards is written and not suppressed
+    TIM.set_conveyor_speed_all(0)
+    assert TIM.conveyor_speed_written
+    assert TIM.suppressed_writes == 0
+
+
+def test_batch_speeds_are_written_in_blocks(TIM, node):
+    speeds = [(conveyor_id, 'speed', 1000 * (nr + 1)) for nr, conveyor_id in enumerate(TIM.INDEX_CONVEYORS)]
+
+    TIM.execute_batch(speeds)
+
+    #7 requests per analog module, the four values of a step in one request
+    assert len(node.writes()) == 7 * len(TIM.SPEED_MODULES)
+    assert [node.registers[address] for address in range(8030, 8034)] == [TIM.conveyor_speed['U'], TIM.conveyor_speed['V'], 0, 0]
+    assert ('write', 8025, [TIM.conveyor_speed[conveyor_id] for conveyor_id in ['A', 'B', 'C', 'D']]) in node.requests
+
+
+def test_homing_counts_no_suppressed_write(TIM, node):
+    for switch_id in TIM.INDEX_SWITCHES:
+        TIM.set_switch(switch_id, pos=0)
+    TIM.execute_batch([('E', 'switch', 0), ('F', 'switch', 0)])
+
+    assert TIM.suppressed_writes == 0
+
+
+def test_reconcile_interval_none_reads_back_every_time(node):
+    TIM = TransportInputModule_Library("127.0.0.1", reconcile_interval=None)
+    TIM.client = node
+    TIM.conveyor_forward('A')
+    set_node_bit(TIM, node, 'A', 0, False)
+
+    TIM.conveyor_forward('A')
+
+    assert TIM.suppressed_writes == 0
+    assert output_bit(TIM, node, 'A', 0)
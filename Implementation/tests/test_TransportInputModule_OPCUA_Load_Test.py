@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("asyncua")
+pytest.importorskip("pyModbusTCP")
+
+from TransportInputModule_OPCUA_Load_Test import SubscriptionHandler
+
+
+def notify(handler, name, value, timestamp):
+    node = SimpleNamespace(nodeid=SimpleNamespace(to_string=lambda: name))
+    data = SimpleNamespace(monitored_item=SimpleNamespace(Value=SimpleNamespace(SourceTimestamp=timestamp)))
+    handler.datachange_notification(node, value, data)
+
+
+def test_only_changes_within_the_window_are_collected():
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    window = {}
+    handler = SubscriptionHandler(window)
+
+    #before the window starts nothing is collected
+    notify(handler, "ns=2;i=1", True, start)
+    window.update({'start' : start, 'end' : start + timedelta(seconds=10)})
+    #initial value, written before the window
+    notify(handler, "ns=2;i=1", True, start - timedelta(seconds=1))
+    notify(handler, "ns=2;i=1", False, start + timedelta(seconds=1))
+    #naive timestamps are UTC
+    notify(handler, "ns=2;i=1", True, (start + timedelta(seconds=2)).replace(tzinfo=None))
+    notify(handler, "ns=2;i=1", False, start + timedelta(seconds=10))
+
+    assert len(handler.changes["ns=2;i=1"]) == 2
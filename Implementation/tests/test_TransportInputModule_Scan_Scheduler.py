@@ -0,0 +1,21 @@
+import threading
+
+from TransportInputModule_Scan_Scheduler import TransportInputModule_Scan_Scheduler
+
+
+def test_failing_cycle_does_not_stop_the_loop():
+    scheduler = TransportInputModule_Scan_Scheduler(period=0.001)
+    stop_event = threading.Event()
+    images = iter(range(1000))
+
+    def logic(image):
+        if image == 1:
+            raise RuntimeError("station failed")
+        if image == 3:
+            stop_event.set()
+
+    scheduler.run(lambda: next(images), logic, lambda: None, stop_event)
+
+    statistics = scheduler.statistics()
+    assert statistics['cycles'] == 4
+    assert statistics['errors'] == 1
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from TransportInputModule_Tracing import TransportInputModule_Tracing
+
+
+def record_handoff(tracer, conveyor_id, switch_id, durations):
+    #records one hand-off with the passed duration per phase, the station span covers all phases
+    begin = 0.0
+    for phase in tracer.PHASES:
+        tracer.record(conveyor_id, switch_id, phase, begin, begin + durations.get(phase, 0.0))
+        begin += durations.get(phase, 0.0)
+    tracer.record(conveyor_id, switch_id, tracer.STATION, 0.0, begin)
+
+
+def test_bottleneck_without_handoff():
+    assert TransportInputModule_Tracing().bottleneck() is None
+
+
+def test_bottleneck_ignores_starved_station():
+    tracer = TransportInputModule_Tracing()
+    #P is starved most of the time, but spends little time on the hand-off itself
+    record_handoff(tracer, 'P', 'O', {'wait_conveyor_end' : 20.0, 'wait_switch_workpiece' : 1.0})
+    record_handoff(tracer, 'A', 'E', {'wait_conveyor_end' : 1.0, 'wait_switch_position' : 3.0, 'wait_switch_workpiece' : 2.0})
+
+    assert tracer.bottleneck() == ('A', 'E', 'wait_switch_position')
+
+
+def test_bottleneck_phase_is_never_idle():
+    tracer = TransportInputModule_Tracing()
+    record_handoff(tracer, 'P', 'O', {'wait_conveyor_end' : 20.0, 'handover' : 0.5})
+
+    assert tracer.bottleneck() == ('P', 'O', 'handover')
+
+
+def test_histogram_bucket_edges():
+    tracer = TransportInputModule_Tracing()
+    #a duration equal to a bound belongs to the bucket of this bound, longer spans to the next one
+    for duration in [0.0, 0.05, 0.0500001, 30.0, 30.1]:
+        tracer.record('A', 'E', 'handover', 0.0, duration)
+
+    counts = tracer.histogram('A', 'E', 'handover')
+    assert len(counts) == len(tracer.HISTOGRAM_BOUNDS) + 1
+    assert counts[0] == 2
+    assert counts[1] == 1
+    assert counts[len(tracer.HISTOGRAM_BOUNDS) - 1] == 1
+    assert counts[-1] == 1
+
+
+def test_statistics_p95_and_window():
+    tracer = TransportInputModule_Tracing(window=100)
+    for duration in range(1, 101):
+        tracer.record('A', 'E', 'handover', 0.0, float(duration))
+
+    statistics = tracer.statistics('A', 'E', 'handover')
+    assert statistics['count'] == 100
+    assert statistics['last'] == 100.0
+    assert statistics['mean'] == pytest.approx(50.5)
+    assert statistics['p95'] == 96.0
+    assert statistics['max'] == 100.0
+
+    #only the latest window spans are kept
+    tracer.record('A', 'E', 'handover', 0.0, 200.0)
+    assert tracer.statistics('A', 'E', 'handover')['count'] == 100
+    assert tracer.statistics('A', 'E', 'wait_switch_position')['count'] == 0
+
+
+def test_export_trace_writes_trace_event_format(tmp_path):
+    tracer = TransportInputModule_Tracing()
+    tracer.record('A', 'E', 'handover', tracer.start_time + 0.5, tracer.start_time + 0.75)
+
+    path = tmp_path / "trace.json"
+    tracer.export_trace(str(path))
+
+    trace = json.loads(path.read_text())
+    assert trace['displayTimeUnit'] == 'ms'
+    assert trace['traceEvents'] == [{
+        'name' : 'handover',
+        'cat' : 'A->E',
+        'ph' : 'X',
+        'ts' : pytest.approx(500000.0),
+        'dur' : pytest.approx(250000.0),
+        'pid' : 1,
+        'tid' : 'station_A_E',
+    }]
@@ -0,0 +1,77 @@
+import pytest
+
+from TransportInputModule_Workpiece_Tracking import TransportInputModule_Workpiece_Tracking
+
+#loop of three stations: A -> B -> C -> A
+LOOP = [("A", "E", "B", 3, 2), ("B", "G", "C", 3, 1), ("C", "K", "A", 1, 3)]
+
+
+def test_new_workpiece_gets_id_on_first_arrival():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, now=0.0)
+
+    assert tracking.arrive('A', now=1.0) == 0
+    assert tracking.arrive('B', now=1.0) == 1
+    assert tracking.pieces_on_conveyor('A') == [0]
+    assert tracking.kpis(now=1.0)['wip'] == 2
+
+
+def test_workpiece_moves_along_the_loop_and_completes_a_lap():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, now=0.0)
+    tracking.arrive('A', now=0.0)
+    for conveyor_id, next_conveyor_id, time in [('A', 'B', 1.0), ('B', 'C', 3.0), ('C', 'A', 5.0)]:
+        tracking.hand_off(conveyor_id, next_conveyor_id, now=time)
+        assert tracking.pieces_on_conveyor(next_conveyor_id) == [0]
+        tracking.arrive(next_conveyor_id, now=time + 1.0)
+
+    kpis = tracking.kpis(now=6.0)
+    assert kpis['laps'] == 1
+    assert kpis['lead_time_last_s'] == pytest.approx(6.0)
+    assert tracking.queue_time('A') == (pytest.approx(1.0), pytest.approx(1.0))
+
+
+def test_pieces_per_minute_uses_uptime_before_the_window_is_full():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, window=60.0, now=0.0)
+    tracking.arrive('A', now=1.0)
+    tracking.hand_off('A', 'B', now=2.0)
+
+    #one hand-off in 10 s at three stations
+    assert tracking.kpis(now=10.0)['pieces_per_minute'] == pytest.approx(6.0 / 3)
+    assert tracking.kpis(now=61.0)['pieces_per_minute'] == pytest.approx(1.0 / 3)
+
+
+def test_remove_workpiece():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, now=0.0)
+    piece = tracking.arrive('A', now=1.0)
+
+    assert tracking.remove(piece)
+    assert not tracking.remove(piece)
+    assert not tracking.remove(42)
+    assert tracking.pieces_on_conveyor('A') == []
+    assert tracking.kpis(now=2.0)['wip'] == 0
+    #the next workpiece at A is a new one
+    assert tracking.arrive('A', now=3.0) == piece + 1
+
+
+def test_reset_removes_all_workpieces_and_kpis():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, now=0.0)
+    tracking.arrive('A', now=1.0)
+    tracking.arrive('B', now=1.0)
+    tracking.hand_off('A', 'B', now=2.0)
+
+    tracking.reset(now=3.0)
+
+    kpis = tracking.kpis(now=4.0)
+    assert kpis['wip'] == 0
+    assert kpis['pieces_per_minute'] == 0.0
+    assert tracking.pieces_on_conveyor('B') == []
+    assert tracking.queue_time('A') == (0.0, 0.0)
+
+
+def test_piece_timeout_removes_lost_workpieces():
+    tracking = TransportInputModule_Workpiece_Tracking(LOOP, piece_timeout=30.0, now=0.0)
+    tracking.arrive('A', now=0.0)
+    tracking.arrive('B', now=20.0)
+
+    assert tracking.kpis(now=40.0)['wip'] == 1
+    assert tracking.pieces_on_conveyor('A') == []
+    assert tracking.pieces_on_conveyor('B') == [1]